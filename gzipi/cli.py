@@ -8,24 +8,36 @@ Type ``gzipi --help`` in the terminal for more information.
 """
 
 #
-# NB. This module automatically discovers subcommands. To implement a new
-# subcommand, create a _subcommand_parser function. For details, see the
-# _create_main_parser function.
+# NB. smart_open and boto3 take a long time to import, so we import them only in
+# the functions that use them.  This keeps ``gzipi --help`` fast.
+#
+
+#
+# NB. To implement a new subcommand, create a _subcommand_subparser function and
+# add it to _SUBPARSERS.  For details, see the _create_parser function.
 #
 
 import argparse
+import functools
+import io
 import logging
+import os
+import shutil
+import subprocess
 import sys
+import threading
 import os.path as P
-import smart_open
 
 from . import lib
 
 _LOGGER = logging.getLogger(__name__)
 _BINARY_STDIN, _BINARY_STDOUT = sys.stdin.buffer, sys.stdout.buffer
 _GZIPI_EXTENSION = '.gzi'
-_CONSENT_STRINGS = ('y', 'yes')
 _ENCODING = 'utf-8'
+_READ_BUFFER_SIZE = 1 << 20
+"""The read buffer size for input streams, in bytes."""
+_IN_MEMORY_KEYS_SIZE = 64 << 20
+"""Below this many bytes, retrieve loads a keys file into memory instead of streaming it."""
 _CLI_DESCRIPTION = """gzipi  <command> [<args>]
 
 Available commands:
@@ -40,7 +52,220 @@ Available commands:
 
 
 def _strip_extension(file_path):
-    return file_path.replace('.gz', '').rsplit('.', 1)[0]
+    """Strip the compression and format extensions, e.g. data.csv.gz -> data."""
+    for extension in ('.gz', '.zst'):
+        if file_path.endswith(extension):
+            file_path = file_path[:-len(extension)]
+            break
+    return P.splitext(file_path)[0]
+
+
+class _PigzWriter:
+    """A binary file-like object that gzips everything written to it using pigz.
+
+    pigz compresses blocks of the input on multiple cores.  The output is
+    an ordinary gzip stream.
+    """
+
+    def __init__(self, pigz_exe, path, threads):
+        import smart_open
+
+        self._path = path
+        self._copier = None
+        self._error = None
+        self._aborted = False
+        if path.startswith('s3://'):
+            #
+            # pigz can't write to S3 directly, so we pump its output through smart_open.
+            #
+            self._fout = smart_open.open(path, 'wb', ignore_ext=True)
+            stdout = subprocess.PIPE
+        else:
+            self._fout = open(path, 'wb')
+            stdout = self._fout
+
+        argv = [pigz_exe, '--stdout', '--processes', str(threads)]
+        self._proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=stdout)
+
+        if stdout == subprocess.PIPE:
+            self._copier = threading.Thread(target=self._copy)
+            self._copier.start()
+
+    def _copy(self):
+        try:
+            shutil.copyfileobj(self._proc.stdout, self._fout)
+        except BaseException as err:
+            #
+            # Hand the error over to the writing thread.  Kill pigz, or it blocks on
+            # its full stdout forever, and the writing thread with it.
+            #
+            self._error = err
+            self._proc.kill()
+
+    def _check(self):
+        if self._error is not None:
+            self._abort()
+            raise self._error
+
+    def _abort(self):
+        """Stop pigz and discard the output, so that a partial file is never committed."""
+        if self._aborted:
+            return
+        self._aborted = True
+        self._proc.kill()
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        if self._copier is not None:
+            self._copier.join()
+            self._proc.stdout.close()
+        self._proc.wait()
+        if hasattr(self._fout, 'terminate'):
+            #
+            # Abort the multipart upload instead of completing it.
+            #
+            self._fout.terminate()
+        else:
+            self._fout.close()
+            os.remove(self._path)
+
+    def write(self, data):
+        self._check()
+        try:
+            return self._proc.stdin.write(data)
+        except BrokenPipeError:
+            self._check()
+            raise
+
+    def writelines(self, lines):
+        self._check()
+        try:
+            self._proc.stdin.writelines(lines)
+        except BrokenPipeError:
+            self._check()
+            raise
+
+    def flush(self):
+        self._check()
+        self._proc.stdin.flush()
+
+    def close(self):
+        if self._aborted:
+            return
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self._copier is not None:
+            self._copier.join()
+            self._proc.stdout.close()
+        returncode = self._proc.wait()
+        self._check()
+        if returncode:
+            self._abort()
+            raise subprocess.CalledProcessError(returncode, self._proc.args)
+        self._fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+
+def _open_pigz_writer(path, threads):
+    """Open a binary stream for writing, gzipping it with pigz if the path ends with .gz.
+
+    Falls back to smart_open when pigz is not available.
+    """
+    import smart_open
+
+    pigz_exe = lib.get_exe('pigz')
+    if path.endswith('.gz') and pigz_exe:
+        return _PigzWriter(pigz_exe, path, threads)
+    return smart_open.open(path, 'wb')
+
+
+class _PigzReader:
+    """A binary file-like object that gunzips a local file using pigz.
+
+    Closing the reader checks the exit code of pigz, so that an index that pigz
+    failed to decompress completely doesn't pass for a shorter one.
+    """
+
+    def __init__(self, pigz_exe, path):
+        argv = [pigz_exe, '--decompress', '--stdout', path]
+        self._proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+        self._eof = False
+
+    def read(self, size=-1):
+        data = self._proc.stdout.read(size)
+        if not data and size != 0:
+            self._eof = True
+        return data
+
+    def readline(self, size=-1):
+        line = self._proc.stdout.readline(size)
+        if not line:
+            self._eof = True
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        self._proc.stdout.close()
+        returncode = self._proc.wait()
+        #
+        # If we stop reading early, pigz dies of a broken pipe, which is expected.
+        # Only a failure before the end of its output means the data was incomplete.
+        #
+        if returncode and self._eof:
+            raise subprocess.CalledProcessError(returncode, self._proc.args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _open_pigz_reader(path):
+    """Open a binary stream for reading, gunzipping it with pigz if the path ends with .gz.
+
+    Falls back to smart_open when pigz is not available or the path is remote.
+    """
+    import smart_open
+
+    pigz_exe = lib.get_exe('pigz')
+    if path.endswith('.gz') and pigz_exe and not path.startswith('s3://'):
+        return _PigzReader(pigz_exe, path)
+    return smart_open.open(path, 'rb')
+
+
+def _open_input(path, ignore_ext=True):
+    """Open a local or S3 file for binary reading, using a large read buffer.
+
+    Set ignore_ext to False to transparently decompress files based on their extension.
+    """
+    import smart_open
+
+    transport_params = {'buffer_size': _READ_BUFFER_SIZE} if path.startswith('s3://') else None
+    fin = smart_open.open(path, 'rb', ignore_ext=ignore_ext, transport_params=transport_params)
+    if '://' in path:
+        return fin
+    lib.fadvise(fin, 'POSIX_FADV_SEQUENTIAL')
+    return io.BufferedReader(fin, buffer_size=_READ_BUFFER_SIZE)
 
 
 def _index_subparser(subparsers):
@@ -62,6 +287,12 @@ def _index_subparser(subparsers):
                         help='The delimiter to use for CSV format.')
     parser.add_argument('--field', required=False, default=lib.DEFAULT_JSON_FIELD,
                         help='The name of key field to use for JSON format.')
+    parser.add_argument('-y', '--force', action='store_true',
+                        help='Overwrite existing output files.')
+    parser.add_argument('--external-sort', action='store_true',
+                        help='Sort the index while writing it, instead of sorting it afterwards.')
+    parser.add_argument('--assume-sorted', action='store_true',
+                        help='Skip sorting the index, because the input is already sorted by key.')
     parser.set_defaults(function=_index)
 
 
@@ -72,7 +303,7 @@ def _index(args):
         sys.exit(1)
 
     if args.input_file:
-        fin = smart_open.open(args.input_file, 'rb', ignore_ext=True)
+        fin = _open_input(args.input_file)
     else:
         fin = _BINARY_STDIN
 
@@ -86,24 +317,29 @@ def _index(args):
         )
         sys.exit(1)
 
-    if args.index_file and _exists(args.index_file):
-        response = input(
-            "Output index path already exists: %s."
-            " Do you want to overwrite it? y/n\n" % str(args.index_file)
+    if not args.force and _exists(args.index_file):
+        _LOGGER.error(
+            "Output index path already exists: %s. Use --force to overwrite it.",
+            args.index_file,
         )
-        if response.lower() not in _CONSENT_STRINGS:
-            _LOGGER.error("Aborting.")
-            sys.exit(1)
+        sys.exit(1)
 
-    fout = smart_open.open(args.index_file, 'wb')
+    fout = _open_pigz_writer(args.index_file, args.threads)
+    if args.external_sort and not args.assume_sorted:
+        fout = lib.ExternalSortWriter(fout)
 
     if args.format == 'csv':
         lib.index_csv_file(csv_file=fin, output_file=fout, column=args.column,
-                           delimiter=args.delimiter)
+                           delimiter=args.delimiter, processes=args.threads)
     else:
-        lib.index_json_file(json_file=fin, output_file=fout, field=args.field)
+        lib.index_json_file(json_file=fin, output_file=fout, field=args.field,
+                            processes=args.threads)
+    lib.fadvise(fin, 'POSIX_FADV_DONTNEED')
     fout.close()
-    lib.sort_file(args.index_file)
+    if not (args.external_sort or args.assume_sorted):
+        lib.sort_file(args.index_file, threads=args.threads)
+    if '://' not in args.index_file:
+        lib.write_index_metadata(args.index_file)
 
 
 def _retrieve_subparser(subparsers):
@@ -122,10 +358,23 @@ def _retrieve_subparser(subparsers):
         '-o', '--output-file', required=False,
         help='The path to save output to. By default, outputs to stdout.'
     )
+    parser.add_argument(
+        '--streaming-keys', action='store_true',
+        help='Look up keys in batches instead of loading them all into memory. '
+             'This is the default for keys read from stdin or from files larger than %d MiB.'
+             % (_IN_MEMORY_KEYS_SIZE >> 20)
+    )
+    parser.add_argument(
+        '--index-sorted', action='store_true',
+        help='Assume the index is sorted by key, even if it has no metadata. '
+             'Indexes that gzipi index and gzipi repack sort are recognized automatically.'
+    )
     parser.set_defaults(function=_retrieve)
 
 
 def _retrieve(args):
+    import smart_open
+
     if not args.index_file:
         args.index_file = _strip_extension(args.input_file) + _GZIPI_EXTENSION
 
@@ -136,22 +385,33 @@ def _retrieve(args):
         sys.exit(1)
 
     if args.keys and not P.exists(args.keys):
-        _LOGGER.error("Keys file does not exist: %s", args.input_file)
+        _LOGGER.error("Keys file does not exist: %s", args.keys)
         _LOGGER.error("Aborting.")
         sys.exit(1)
 
-    keys_fin = smart_open.open(args.keys, mode='rb') if args.keys else _BINARY_STDIN
+    keys_fin = _open_input(args.keys, ignore_ext=False) if args.keys else _BINARY_STDIN
+    if not args.streaming_keys and args.keys and os.stat(args.keys).st_size < _IN_MEMORY_KEYS_SIZE:
+        #
+        # Read a modest number of keys up front, so that they are looked up in
+        # a single pass over the index.
+        #
+        keys_fin = frozenset(filter(None, map(bytes.strip, keys_fin)))
 
     if args.output_file:
         fout = smart_open.open(args.output_file, mode='wb', ignore_ext=True)
     else:
         fout = _BINARY_STDOUT
 
-    index_fin = smart_open.open(args.index_file, 'r')
-    lib.retrieve(
-        keys_fin=keys_fin, file_path=args.input_file,
-        index_fin=index_fin, output_stream=fout,
-    )
+    #
+    # Only the indexes that we sorted ourselves have metadata.  Bisecting any other
+    # index could miss keys, so those get a full scan.
+    #
+    index_sorted = args.index_sorted or lib.has_index_metadata(args.index_file)
+    with _open_pigz_reader(args.index_file) as index_fin:
+        lib.retrieve(
+            keys_fin=keys_fin, file_path=args.input_file,
+            index_fin=index_fin, output_stream=fout, index_sorted=index_sorted,
+        )
 
 
 def _search_subparser(subparsers):
@@ -168,10 +428,18 @@ def _search_subparser(subparsers):
         '-o', '--output-file', required=False,
         help='The path to save output to. By default, outputs to stdout.'
     )
+    parser.add_argument(
+        '--no-mmap', action='store_true',
+        help='Do not memory-map local index files. Otherwise, a gzipped index is '
+             'decompressed once to INDEX.idx next to it, or to gzipi-<hash>.idx in the '
+             'temporary directory if that is read-only, and the copy is reused.'
+    )
     parser.set_defaults(function=_search)
 
 
 def _search(args):
+    import smart_open
+
     if not args.index_file:
         args.index_file = _strip_extension(args.input_file) + _GZIPI_EXTENSION
 
@@ -179,19 +447,41 @@ def _search(args):
 
     key = args.key.encode(_ENCODING)
     try:
-        lib.search(key, args.input_file, args.index_file, fout)
+        lib.search(key, args.input_file, args.index_file, fout, use_mmap=not args.no_mmap)
     except KeyError:
         _LOGGER.error("Can't look up %s key in the index file." % args.key)
         sys.exit(1)
 
 
+@functools.lru_cache(maxsize=256)
 def _exists(path):
+    #
+    # The result is cached: the paths don't change while a command is checking them,
+    # and each S3 check is a network round-trip.
+    #
     if path.startswith('s3://'):
+        import botocore.exceptions
+
+        #
+        # A HEAD request only fetches the object metadata, unlike opening and reading the object.
+        # Use the same client as the rest of the library, so that the same endpoint applies.
+        #
+        bucket, _, key = path[len('s3://'):].partition('/')
         try:
-            with smart_open.open(path, 'rb', ignore_ext=True) as fin:
-                fin.read(1)
-        except IOError:
-            return False
+            lib._s3_client().head_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError as err:
+            code = err.response.get('Error', {}).get('Code')
+            if code in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            if code in ('403', 'Forbidden', 'AccessDenied'):
+                #
+                # Without s3:ListBucket, S3 answers 403 for missing keys too.
+                #
+                _LOGGER.warning(
+                    "Can't tell whether %s exists (access denied); assuming it doesn't.", path,
+                )
+                return False
+            raise
         else:
             return True
     else:
@@ -217,25 +507,28 @@ def _repack_subparser(subparsers):
                         help='The delimiter to use for CSV format.')
     parser.add_argument('--field', required=False, default=lib.DEFAULT_JSON_FIELD,
                         help='The name of key field to use for JSON format.')
-    parser.add_argument('--chunk-size', required=False, default=lib.DEFAULT_CHUNK_SIZE,
+    parser.add_argument('--chunk-size', type=int, required=False, default=lib.DEFAULT_CHUNK_SIZE,
                         help='The number of lines to pack into a single chunk.')
+    parser.add_argument('-y', '--force', action='store_true',
+                        help='Overwrite existing output files.')
+    parser.add_argument('--external-sort', action='store_true',
+                        help='Sort the index while writing it, instead of sorting it afterwards.')
+    parser.add_argument('--assume-sorted', action='store_true',
+                        help='Skip sorting the index, because the input is already sorted by key.')
     parser.set_defaults(function=_repack)
 
 
 def _repack(args):
-    if args.input_file:
-        fin = smart_open.open(args.input_file, 'rb', ignore_ext=True)
-    else:
-        fin = _BINARY_STDIN
-
-    if not args.index_file and args.output_file:
-        args.index_file = _strip_extension(args.output_file) + _GZIPI_EXTENSION
+    import smart_open
 
     if isinstance(args.input_file, str) and not _exists(args.input_file):
         _LOGGER.error("Input file does not exist: %s", args.input_file)
         _LOGGER.error("Aborting.")
         sys.exit(1)
 
+    if not args.index_file and args.output_file:
+        args.index_file = _strip_extension(args.output_file) + _GZIPI_EXTENSION
+
     if not args.index_file:
         _LOGGER.error(
             "Can't determine path for index file. "
@@ -243,25 +536,20 @@ def _repack(args):
         )
         sys.exit(1)
 
-    if P.exists(args.index_file):
-        response = input(
-            "Output index path already exists: %s."
-            " Do you want to overwrite it? y/n\n" % args.index_file
-        )
-        if response.lower() not in _CONSENT_STRINGS:
-            _LOGGER.error("Aborting.")
+    outputs = (('Output index path', args.index_file), ('Output path', args.output_file))
+    for description, path in outputs:
+        if not args.force and path and _exists(path):
+            _LOGGER.error("%s already exists: %s. Use --force to overwrite it.", description, path)
             sys.exit(1)
 
-    if P.exists(args.output_file):
-        response = input(
-            "Output path already exists: %s."
-            " Do you want to overwrite it? y/n\n" % args.output_file
-        )
-        if response.lower() not in _CONSENT_STRINGS:
-            _LOGGER.error("Aborting.")
-            sys.exit(1)
+    if args.input_file:
+        fin = _open_input(args.input_file)
+    else:
+        fin = _BINARY_STDIN
 
-    index_fout = smart_open.open(args.index_file, 'wb')
+    index_fout = _open_pigz_writer(args.index_file, args.threads)
+    if args.external_sort and not args.assume_sorted:
+        index_fout = lib.ExternalSortWriter(index_fout)
 
     output_compression = lib.assume_compression_from_filename(args.output_file)
     assert output_compression in lib.SUPPORTED_COMPRESSIONS
@@ -276,16 +564,29 @@ def _repack(args):
             fin=fin, fout=fout,
             index_fout=index_fout, chunk_size=args.chunk_size,
             column=args.column, delimiter=args.delimiter,
-            output_compression=output_compression,
+            output_compression=output_compression, processes=args.threads,
         )
     else:
         lib.repack_json_file(
             fin=fin, fout=fout,
             index_fout=index_fout, chunk_size=args.chunk_size,
-            field=args.field,
+            field=args.field, processes=args.threads,
         )
+    lib.fadvise(fin, 'POSIX_FADV_DONTNEED')
     fout.close()
-    lib.sort_file(args.index_file)
+    index_fout.close()
+    if not (args.external_sort or args.assume_sorted):
+        lib.sort_file(args.index_file, threads=args.threads)
+    if '://' not in args.index_file:
+        lib.write_index_metadata(args.index_file)
+
+
+_SUBPARSERS = (
+    _index_subparser,
+    _repack_subparser,
+    _retrieve_subparser,
+    _search_subparser,
+)
 
 
 def _create_parser():
@@ -295,25 +596,33 @@ def _create_parser():
         '-l', '--loglevel', default=logging.ERROR,
         help='Set the minimum level for log messages'
     )
+    parser.add_argument(
+        '-j', '--threads', type=int, default=os.cpu_count() or 1,
+        help='The number of worker processes to index and repack with, and of threads '
+             'to compress and sort with. Defaults to the number of CPUs.'
+    )
 
     subparsers = parser.add_subparsers(help='sub-command --help')
 
-    functions = [v for (k, v) in globals().items() if k.endswith('_subparser')]
-    for func in sorted(functions, key=lambda f: f.__name__):
+    for func in _SUBPARSERS:
         func(subparsers)
 
     return parser
 
 
+def _configure_s3_logging():
+    """Silence the chatty loggers of the libraries we use to access S3."""
+    for name in ('boto3', 'botocore', 'urllib3', 'smart_open'):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+
 def main():
     parser = _create_parser()
     args = parser.parse_args()
 
     logging.basicConfig(level=args.loglevel)
-    logging.getLogger('boto3').setLevel(logging.ERROR)
-    logging.getLogger('botocore').setLevel(logging.ERROR)
-    logging.getLogger('urllib3').setLevel(logging.ERROR)
-    logging.getLogger('smart_open').setLevel(logging.ERROR)
+    if any(isinstance(value, str) and value.startswith('s3://') for value in vars(args).values()):
+        _configure_s3_logging()
 
     logging.debug('args: %r', args)
 
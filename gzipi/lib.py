@@ -51,27 +51,39 @@ The main entry points of this module are:
 """
 
 import collections
+import concurrent.futures
+import contextlib
 import csv
-import distutils.spawn
 import enum
+import errno
 import functools
 import gzip
+import hashlib
+import heapq
 import io
+import itertools
 import json
 import logging
+import mmap
 import multiprocessing
 import os
+import os.path as P
+import queue
 import shutil
+import stat
 import struct
 import sys
 import tempfile
+import threading
 import time
 
 from typing import (
+    AbstractSet,
     Any,
     Callable,
     cast,
     Dict,
+    Generator,
     IO,
     Iterable,
     List,
@@ -80,11 +92,23 @@ from typing import (
     Union,
 )
 
-import botocore.exceptions
-import plumbum
-import smart_open
 import zstandard
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+#
+# NB. botocore, plumbum and smart_open are slow to import, so we import them only in
+# the functions that use them.
+#
+
 _GZIP_HEADER = b'\x1f\x8b\x08'
 """A magic gzip header and two compression flags.
 
@@ -115,8 +139,6 @@ _ZSTD_HEADER_LENGTH = 18
 
 https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#frame_header
 """
-_WINDOW_OFFSET_GZIP = (_GZIP_HEADER_LENGTH - 1) * -1
-_WINDOW_OFFSET_ZST = (_ZSTD_HEADER_LENGTH - 1) * -1
 _MIN_CHUNK_SIZE = 100000
 """The minimum amount of bytes in each chunk.
 
@@ -133,6 +155,9 @@ DEFAULT_CSV_COLUMN = 0
 DEFAULT_CSV_DELIMITER = '|'
 """The character used for delimiting CSV columns."""
 
+_CSV_QUOTE_CHAR = b'"'
+"""The character csv.reader uses for quoting fields."""
+
 DEFAULT_JSON_FIELD = 'domain'
 """The field to use when indexing JSON."""
 
@@ -142,7 +167,13 @@ _OLDEST_UNIX_TIMESTAMP = 1262307600
 Currently, set to 2010-01-01.
 """
 
-_POSSIBLE_OS_TYPES = (0x00, 0x03, 0x07, 0xFF)
+_GZIP_MTIME_SLACK = 24 * 60 * 60
+"""How far past the current time a timestamp in the gzip header may be, in seconds.
+
+Members written while we read the file, or on a machine with a skewed clock, are still valid.
+"""
+
+_POSSIBLE_OS_TYPES = frozenset((0x00, 0x03, 0x07, 0xFF))
 """Possible values for Operating System field in the gzip header.
 
 Currently, set to Windows, Unix, Macintosh and Other.
@@ -155,9 +186,27 @@ DEFAULT_CHUNK_SIZE = 5000
 _MAX_RECORDS_PER_BATCH = 5000
 """The maximum number of records to retrieve in a single batch."""
 
-_SORT_CPU_COUNT = multiprocessing.cpu_count()
+_CPU_COUNT = multiprocessing.cpu_count()
+
+_POOL_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+"""The context that worker pools start their processes in.
+
+Forking copies the state of every thread, e.g. one that holds a lock or pumps pigz
+output, so we start workers from a clean server process instead.
+"""
 _SORT_BUFFER_SIZE = '1G'
 
+_SORT_RUN_SIZE = 1000000
+"""The maximum number of index lines to sort in memory before spilling them to disk."""
+
+_IN_MEMORY_SORT_SIZE = 1 << 20
+"""The size of the largest index file to sort in memory rather than with GNU sort, in bytes.
+
+Below this size, starting the sort pipeline costs more than sorting in Python.
+"""
+
 _LOGGER = logging.getLogger(__name__)
 _LOGGER.addHandler(logging.NullHandler())
 
@@ -166,10 +215,54 @@ csv.field_size_limit(sys.maxsize)
 _DEFAULT_BUFFER_SIZE = 1024
 """The maximum size of the index file to load in memory when performing binary search, in KiB."""
 
+_LINEAR_SEARCH_SIZE = mmap.PAGESIZE
+"""Below this many bytes, binary search scans the remaining lines instead of bisecting them."""
+
 _BYTES_IN_KiB = 1024
 
+_READ_BUFFER_SIZE = 64 * _BYTES_IN_KiB
+"""The size of the buffer that decompressed lines are read through, in bytes."""
+
+_PREFETCH_SIZE = 4
+"""The number of decompressed chunks to hold in memory ahead of indexing them."""
+
+_PREFETCH_TIMEOUT = 0.1
+"""How often a prefetching thread blocked on a full queue checks whether to stop, in seconds."""
+
+_BISECT_COST = 16 * _BYTES_IN_KiB
+"""The rough amount of index data read when looking up a single key by bisection, in bytes.
+
+When looking up fewer keys than the index size divided by this, retrieve bisects the
+index for each key instead of reading all of it.
+"""
+
+_MAX_READ_GAP = 256 * _BYTES_IN_KiB
+"""The largest gap between two chunks that retrieve reads through instead of seeking over.
+
+Reading a little unneeded data is cheaper than another request, especially on S3.
+"""
+
+_MAX_READ_SIZE = 64 * _BYTES_IN_KiB * _BYTES_IN_KiB
+"""The most data retrieve reads in a single request, in bytes."""
+
+_CHUNK_CACHE_SIZE = 64 * _BYTES_IN_KiB * _BYTES_IN_KiB
+"""The most decompressed data retrieve keeps around for later batches of keys, in bytes."""
+
+_S3_CONCURRENCY = 8
+"""The number of range requests retrieve keeps in flight when reading from S3."""
+
+_S3_MAX_IN_FLIGHT = 128 * _BYTES_IN_KiB * _BYTES_IN_KiB
+"""The most data retrieve requests from S3 at once, in bytes.
+
+Limits memory when the runs are large, while small runs still get the full concurrency.
+"""
+
 _LINE_TERMINATOR = b'\n'
 
+_gzip_reader = igzip if igzip is not None else gzip
+"""The module to decompress gzip with.  ISA-L's igzip is several times faster than gzip,
+if installed.  We still compress with gzip, so that repacked files stay byte-identical."""
+
 
 class Compression(enum.Enum):
     NONE = None
@@ -195,6 +288,11 @@ def assume_compression_from_filename(path: str) -> Optional[str]:
 def _determine_compression_from_header(fin: IO[bytes]) -> Optional[str]:
     header = fin.read(4)
     fin.seek(0)
+    return _compression_from_magic(header)
+
+
+def _compression_from_magic(header: bytes) -> Optional[str]:
+    """Determine the compression of data from its first few bytes."""
     if header.startswith(_GZIP_HEADER):
         return Compression.GZIP.value
     elif header.startswith(_ZSTD_HEADER):
@@ -209,13 +307,21 @@ def _open_compressed_file(
 ) -> IO:
     """Open the specified file for reading/writing.
 
-    Transparently opens compressed (``.gz``, ``.zst``) files.
+    Transparently opens compressed (``.gz``, ``.zst``) files.  Uncompressed
+    binary streams are returned as is.
     """
     if 'b' not in mode and 't' not in mode:
         mode += 't'
     encoding = None if 'b' in mode else _TEXT_ENCODING
     if compression == Compression.GZIP.value:
-        return cast(IO, gzip.open(path, mode, encoding=encoding))
+        if mode == 'rb':
+            #
+            # Gzip readers hand out lines from an 8 KiB buffer.  Reading lines
+            # through a larger one takes half as long.
+            #
+            return cast(IO, io.BufferedReader(_gzip_reader.open(path, mode), _READ_BUFFER_SIZE))
+        opener = _gzip_reader.open if 'r' in mode else gzip.open
+        return cast(IO, opener(path, mode, encoding=encoding))
     elif compression == Compression.ZSTD.value:
         #
         # zstandard does not support some operations for binary data (e.g. readline)
@@ -223,103 +329,395 @@ def _open_compressed_file(
         #
         reader = zstandard.open(path, mode, encoding=encoding)  # type: ignore
         if 'b' in mode:
-            reader = io.BufferedReader(reader) if 'r' in mode else io.BufferedWriter(reader)
+            if 'r' in mode:
+                reader = io.BufferedReader(reader, _READ_BUFFER_SIZE)
+            else:
+                reader = io.BufferedWriter(reader)
         return cast(IO, reader)
+    elif compression == Compression.NONE.value:
+        if isinstance(path, str):
+            return open(path, mode, encoding=encoding)
+        elif 'b' in mode:
+            return path
+        return io.TextIOWrapper(path, encoding=encoding)
     else:
         raise ValueError("Unsupported compression format: %r" % compression)
 
 
-def _is_valid_gzip_header(header: bytes) -> bool:
+def _decompress(data: bytes, compression: Optional[str]) -> bytes:
+    """Decompress a chunk that is entirely in memory.
+
+    Decompressing gzip in a single call is faster than reading it through a stream.
+    """
+    if compression == Compression.GZIP.value:
+        return _gzip_reader.decompress(data)
+    with _open_compressed_file(io.BytesIO(data), compression, mode='rb') as fin:
+        return fin.read()
+
+
+def _decompress_head(data: bytes, compression: Optional[str], size: int) -> bytes:
+    """Decompress only the first size bytes of a chunk that is entirely in memory.
+
+    A file that was never repacked is a single chunk, so inflating all of it
+    just to get at one line could take as much memory as the uncompressed file.
+    """
+    with _open_compressed_file(io.BytesIO(data), compression, mode='rb') as fin:
+        return fin.read(size)
+
+
+_GZIP_MTIME_OS = struct.Struct('<ixB')
+"""The modification time and OS fields of the gzip header, from offset 4."""
+
+
+def _is_valid_gzip_header(buf: bytes, offset: int = 0, now: Optional[float] = None) -> bool:
     #
     # Extra sanity checks to ensure that we are working with the actual gzip header.
     # There is a chance that compressed data may look like the start of gzip header.
     #
-    if len(header) < _GZIP_HEADER_LENGTH:
+    # The header is checked in place, at the offset into buf, without slicing it out.
+    #
+    if len(buf) - offset < _GZIP_HEADER_LENGTH:
         return False
 
-    try:
-        unix_timestamp = struct.unpack("i", header[4:8])[0]
-    except Exception as err:
-        _LOGGER.debug("Can't parse GZIP header: %s", err)
+    unix_timestamp, os_type = _GZIP_MTIME_OS.unpack_from(buf, offset + 4)
+    if now is None:
+        now = time.time()
+    if not _OLDEST_UNIX_TIMESTAMP <= unix_timestamp <= now + _GZIP_MTIME_SLACK:
         return False
 
-    if unix_timestamp < _OLDEST_UNIX_TIMESTAMP or unix_timestamp > time.time():
-        return False
+    return os_type in _POSSIBLE_OS_TYPES
+
 
-    if header[9] not in _POSSIBLE_OS_TYPES:
+def _is_valid_zstd_header(buf: bytes, offset: int = 0) -> bool:
+    #
+    # The frame header descriptor follows the magic number.  Its unused (4) and
+    # reserved (3) bits must be zero, and we expect a content checksum (bit 2).
+    #
+    if len(buf) - offset < 5:
         return False
+    flags = buf[offset + 4]
+    return flags & 0x18 == 0 and flags & 0x04 != 0
 
-    flags = header[4]
-    if flags > 0xfc:
-        return True
 
-    return True
+def _iterate_blocks(
+    fin: IO[bytes],
+    buffer_size: int = _MIN_CHUNK_SIZE,
+) -> Iterable[Tuple[bytes, int, int]]:
+    #
+    # Uncompressed files don't need to be inflated.  We split them into blocks
+    # of complete lines, so that each block can be read without the rest of the file.
+    #
+    start_offset = 0
+    while True:
+        block = fin.read(buffer_size)
+        if not block:
+            return
+        if not block.endswith(_LINE_TERMINATOR):
+            block += fin.readline()
+        end_offset = start_offset + len(block)
+        yield block, start_offset, end_offset
+        start_offset = end_offset
+
 
+def _find_header(
+    archive: Any,
+    scan_from: int,
+    header: bytes,
+    header_length: int,
+    valid_header: Callable[[Any, int], bool],
+    end: Optional[int] = None,
+) -> int:
+    """Return the position of the last valid header between scan_from and end, or -1.
 
-def _is_valid_zstd_header(header: bytes) -> bool:
-    flags = header[4:5]
-    binary_string = "{:08b}".format(int(flags.hex(), 16))
-    if not binary_string[3:5] == '00':
-        return False
-    if not binary_string[5] == '1':
-        return False
-    return True
+    Compressed data may contain the magic bytes by chance, so we keep looking
+    further back when the last candidate turns out not to be a header.
+    """
+    if end is None:
+        end = len(archive)
+    scan_to = end
+    while True:
+        header_pos = archive.rfind(header, scan_from, scan_to)
+        if header_pos == -1:
+            return -1
+        if end - header_pos >= header_length and valid_header(archive, header_pos):
+            return header_pos
+        scan_to = header_pos + len(header) - 1
+
+
+def _map_file(fin: IO[bytes]) -> Optional[mmap.mmap]:
+    """Memory-map a stream if it is a regular, non-empty local file, or return None."""
+    try:
+        fileno = fin.fileno()
+        if not stat.S_ISREG(os.fstat(fileno).st_mode) or os.fstat(fileno).st_size == 0:
+            return None
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
+
+
+def _iterate_mapped_archives(
+    mm: mmap.mmap,
+    start: int,
+    buffer_size: int,
+    header: bytes,
+    header_length: int,
+    valid_header: Callable[[Any, int], bool],
+) -> Iterable[Tuple[bytes, int, int]]:
+    #
+    # Splits the file exactly like the stream version of _iterate_archives, which
+    # reads it buffer_size bytes at a time.  Scanning the mapping directly saves
+    # copying the file into a read buffer and then into the archive.
+    #
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+
+    base = archive_start = archive_end = start
+    size = len(mm)
+    while archive_end < size:
+        scan_from = max(archive_start + 1, archive_end - header_length + 1)
+        archive_end = min(archive_end + buffer_size, size)
+        header_pos = _find_header(
+            mm, scan_from, header, header_length, valid_header, end=archive_end,
+        )
+        if header_pos == -1:
+            continue
+
+        yield mm[archive_start:header_pos], archive_start - base, header_pos - base
+        archive_start = header_pos
+
+    yield mm[archive_start:size], archive_start - base, size - base
 
 
 def _iterate_archives(
     fin: IO[bytes],
     buffer_size: int = _MIN_CHUNK_SIZE,
     compression: Optional[str] = Compression.GZIP.value
-) -> Iterable[Tuple[IO[bytes], int, int]]:
+) -> Iterable[Tuple[bytes, int, int]]:
     #
-    # We could use ByteIO container here, but byte strings work faster and easier
-    # to work with for our particular case.
+    # We could use ByteIO container here, but byte arrays work faster and easier
+    # to work with for our particular case.  Unlike byte strings, they grow in place,
+    # so appending a chunk doesn't copy the whole archive.
     #
-    archive = b""
+    if compression == Compression.NONE.value:
+        yield from _iterate_blocks(fin, buffer_size)
+        return
+
+    archive = bytearray()
     start_offset, end_offset = 0, 0
 
     assert compression in SUPPORTED_COMPRESSIONS
     if compression == Compression.GZIP.value:
-        w_offset, header, header_length = _WINDOW_OFFSET_GZIP, _GZIP_HEADER, _GZIP_HEADER_LENGTH
-        valid_header = _is_valid_gzip_header
+        header, header_length = _GZIP_HEADER, _GZIP_HEADER_LENGTH
+        #
+        # Take the time once, instead of for every candidate header.  The slack
+        # admits the members that are written while we read, e.g. through a pipe.
+        #
+        valid_header = functools.partial(_is_valid_gzip_header, now=time.time())
     else:
-        w_offset, header, header_length = _WINDOW_OFFSET_ZST, _ZSTD_HEADER, _ZSTD_HEADER_LENGTH
+        header, header_length = _ZSTD_HEADER, _ZSTD_HEADER_LENGTH
         valid_header = _is_valid_zstd_header
 
+    mm = _map_file(fin)
+    if mm is not None:
+        with mm:
+            yield from _iterate_mapped_archives(
+                mm, fin.tell(), buffer_size, header, header_length, valid_header,
+            )
+        return
+
+    #
+    # Read into a single reusable buffer, so each read doesn't allocate a fresh
+    # byte string only to copy it onto the end of the archive.
+    #
+    buf = bytearray(buffer_size)
+    buf_view = memoryview(buf)
     while True:
-        chunk = fin.read(buffer_size)
+        read = fin.readinto(buf)
 
-        if not chunk:
+        if not read:
             start_offset = end_offset
             end_offset = start_offset + len(archive)
 
-            yield io.BytesIO(archive), start_offset, end_offset
+            yield bytes(archive), start_offset, end_offset
             return
 
         #
-        # Include data from the previous chunk to be sure that gzip/zstd header won't be splitted
-        # across multiple chunks.
+        # Only scan the new data, plus the tail of the previous data to be sure that
+        # a gzip/zstd header split across multiple chunks isn't missed.  The rest of
+        # the archive has been scanned already.  The header at the very start of the
+        # archive is the one we split on last time, so we never look at it.
         #
-        window = archive[w_offset:] + chunk
-        archive += chunk
-        if len(window) < header_length or window.rfind(header) == -1:
-            continue
-
-        header_pos = archive.rfind(header)
-        if any([
-            header_pos <= 0,
-            len(archive) < header_length,
-            len(archive) - header_pos < header_length,
-            not valid_header(archive[header_pos:header_pos + header_length])
-        ]):
+        scan_from = max(1, len(archive) - header_length + 1)
+        archive += buf_view[:read]
+        header_pos = _find_header(archive, scan_from, header, header_length, valid_header)
+        if header_pos == -1:
             continue
 
-        new_archive = archive[header_pos:]
-        archive = archive[0:header_pos]
         start_offset = end_offset
-        end_offset = start_offset + len(archive)
-        yield io.BytesIO(archive), start_offset, end_offset
-        archive = new_archive
+        end_offset = start_offset + header_pos
+        #
+        # Copy the chunk out exactly once, without slicing the bytearray first.
+        #
+        with memoryview(archive) as view:
+            chunk = bytes(view[:header_pos])
+        yield chunk, start_offset, end_offset
+        del archive[:header_pos]
+
+
+def _encode_key(key: Any) -> bytes:
+    #
+    # JSON fields may hold numbers as well as strings.  All the other fields
+    # of an index line are integers, so we can format the whole line as bytes.
+    #
+    if isinstance(key, bytes):
+        return key
+    return str(key).encode(_TEXT_ENCODING)
+
+
+def _read_archives(
+    chunk_iterator: Iterable[Tuple[bytes, int, int]],
+) -> Iterable[Tuple[bytes, int, int]]:
+    for i, (arch, start_offset, end_offset) in enumerate(chunk_iterator):
+        _LOGGER.info('processed %s chunk, offset: %s-%s' % (i, start_offset, end_offset))
+        yield arch, start_offset, end_offset
+
+
+def _prefetch(iterable: Iterable, size: int = _PREFETCH_SIZE) -> Generator:
+    """Like iter, but produces the items in a background thread, a few items ahead.
+
+    The work of producing the items overlaps with the work of consuming them, as
+    long as one of them releases the GIL (e.g. to read or decompress data).
+
+    Closing the generator stops the thread and waits for it, so that it no longer
+    touches whatever the items are read from.
+    """
+    items = queue.Queue(maxsize=size)  # type: queue.Queue
+    stop = threading.Event()
+    done = object()
+
+    def put(entry) -> bool:
+        #
+        # Don't block on a full queue forever, in case the consumer has gone away.
+        #
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=_PREFETCH_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as err:
+            put((None, err))
+            return
+        put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, err = items.get()
+            if err is not None:
+                raise err
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _inflate_archive(archive: Tuple[bytes, int, int], compression: str) -> Tuple[bytes, int, int]:
+    arch, start_offset, end_offset = archive
+    return _decompress(arch, compression), start_offset, end_offset
+
+
+def _chunk_index(start_offset: int, end_offset: int) -> bytes:
+    #
+    # The chunk columns are the same for every line of a chunk, so we format
+    # them once, delimiters included, and splice them into each index line.
+    #
+    return b'|%d|%d|' % (start_offset, end_offset - start_offset)
+
+
+def _split_key(line: bytes, column: int, delimiter: bytes) -> bytes:
+    """Return the key column of an unquoted CSV line."""
+    fields = line.split(delimiter, column + 1)
+    if len(fields) > column + 1:
+        return fields[column]
+    #
+    # Only the last field ends with the line terminator, so only strip that one.
+    #
+    return fields[column].rstrip(b'\r\n')
+
+
+def _index_csv_data(inflated: Tuple[bytes, int, int], column: int, delimiter: str) -> bytes:
+    """Index the lines of a single decompressed chunk of a CSV file."""
+    data, start_offset, end_offset = inflated
+    line_start, line_end = 0, 0
+    chunk_index = _chunk_index(start_offset, end_offset)
+
+    index = []
+    if _CSV_QUOTE_CHAR not in data:
+        #
+        # Without quotes, CSV fields are simply delimited, so we can split the
+        # raw lines instead of decoding them and running them through csv.reader.
+        #
+        delimiter_bytes = delimiter.encode(_TEXT_ENCODING)
+        for line in io.BytesIO(data):
+            key = _split_key(line, column, delimiter_bytes)
+            line_start = line_end
+            line_end = line_start + len(line)
+            index.append(b'%s%s%d|%d\n' % (key, chunk_index, line_start, line_end - line_start))
+        return b''.join(index)
+
+    with io.BytesIO(data) as fin:
+        #
+        # csv.reader pulls lines one at a time, and a quoted field may span several
+        # of them, so the position in the buffer marks the end of each record.
+        #
+        csv_reader = csv.reader((line.decode(_TEXT_ENCODING) for line in fin), delimiter=delimiter)
+        for row in csv_reader:
+            line_start = line_end
+            line_end = fin.tell()
+            index.append(b'%s%s%d|%d\n' % (
+                _encode_key(row[column]), chunk_index, line_start, line_end - line_start,
+            ))
+    return b''.join(index)
+
+
+def _index_csv_chunk(
+    archive: Tuple[bytes, int, int],
+    compression: str,
+    column: int,
+    delimiter: str,
+) -> bytes:
+    """Index the lines of a single compressed chunk of a CSV file."""
+    return _index_csv_data(_inflate_archive(archive, compression), column, delimiter)
+
+
+def _index_archives(
+    archives: Iterable[Tuple[bytes, int, int]],
+    compression: str,
+    index_data: Callable,
+    index_chunk: Callable,
+    processes: int,
+) -> Iterable[bytes]:
+    if processes > 1:
+        return _ordered_map(index_chunk, archives, processes)
+
+    #
+    # Without worker processes, decompress the next chunks in a background thread
+    # while we index the current one.  zlib and zstandard release the GIL while
+    # they decompress, so the two actually run at the same time.
+    #
+    inflate = functools.partial(_inflate_archive, compression=compression)
+    return map(index_data, _prefetch(map(inflate, archives)))
 
 
 def index_csv_file(
@@ -327,7 +725,8 @@ def index_csv_file(
     output_file: IO[bytes],
     column: int = DEFAULT_CSV_COLUMN,
     delimiter: str = DEFAULT_CSV_DELIMITER,
-    min_chunk_size: int = _MIN_CHUNK_SIZE
+    min_chunk_size: int = _MIN_CHUNK_SIZE,
+    processes: int = 1,
 ) -> None:
     """Index a compressed CSV file from the file stream.
 
@@ -336,6 +735,7 @@ def index_csv_file(
     :param int column: The index of the key column in the input file.
     :param str delimiter: The CSV delimiter to use.
     :param int min_chunk_size: The minimum number of bytes in a single chunk.
+    :param int processes: The number of processes to index chunks in.
     """
     compression = _determine_compression_from_header(csv_file)
     chunk_iterator = _iterate_archives(
@@ -343,28 +743,56 @@ def index_csv_file(
         buffer_size=min_chunk_size,
         compression=compression
     )
-    for i, (arch, start_offset, end_offset) in enumerate(chunk_iterator):
-        _LOGGER.info('processed %s chunk, offset: %s-%s' % (i, start_offset, end_offset))
-        line_start, line_end = 0, 0
-        with _open_compressed_file(arch, compression, mode='rb') as fin:
-            csv_in = _StreamWrapper(fin, decode_lines=True)
-            csv_reader = csv.reader(csv_in, delimiter=delimiter)
-            for row in csv_reader:
-                line_start = line_end
-                line_end = line_start + len(csv_in.current_line)
-                index = '%s|%s|%s|%s|%s' % (
-                    row[column], start_offset,
-                    end_offset - start_offset,
-                    line_start, line_end - line_start,
-                )
-                output_file.write(index.encode(_TEXT_ENCODING) + _LINE_TERMINATOR)
+    index_data = functools.partial(_index_csv_data, column=column, delimiter=delimiter)
+    index_chunk = functools.partial(
+        _index_csv_chunk, compression=compression, column=column, delimiter=delimiter,
+    )
+    archives = _read_archives(chunk_iterator)
+    for index in _index_archives(archives, compression, index_data, index_chunk, processes):
+        output_file.write(index)
+
+
+def _json_loads(data: bytes) -> Any:
+    """Parse a JSON document from bytes.  orjson is several times faster than json, if installed.
+
+    orjson rejects some documents that json accepts, like NaN and integers wider
+    than 64 bits, so we fall back to json for those.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def _index_json_data(inflated: Tuple[bytes, int, int], field: str) -> bytes:
+    """Index the lines of a single decompressed chunk of a JSON file."""
+    data, start_offset, end_offset = inflated
+    line_start, line_end = 0, 0
+    chunk_index = _chunk_index(start_offset, end_offset)
+    index = []
+    for line in io.BytesIO(data):
+        record = _json_loads(line)
+        line_start = line_end
+        line_end = line_start + len(line)
+        index.append(b'%s%s%d|%d\n' % (
+            _encode_key(record[field]), chunk_index, line_start, line_end - line_start,
+        ))
+    return b''.join(index)
+
+
+def _index_json_chunk(archive: Tuple[bytes, int, int], compression: str, field: str) -> bytes:
+    """Index the lines of a single compressed chunk of a JSON file."""
+    return _index_json_data(_inflate_archive(archive, compression), field)
 
 
 def index_json_file(
     json_file: IO[bytes],
     output_file: IO[bytes],
     field: str = DEFAULT_JSON_FIELD,
-    min_chunk_size: int = _MIN_CHUNK_SIZE
+    min_chunk_size: int = _MIN_CHUNK_SIZE,
+    processes: int = 1,
 ) -> None:
     """Index a compressed JSON file from the file stream.
 
@@ -372,6 +800,7 @@ def index_json_file(
     :param output_file: The binary file stream to write output to.
     :param field: The name of the key field in the JSON file.
     :param min_chunk_size: The minimum number of bytes in a single chunk.
+    :param processes: The number of processes to index chunks in.
     """
     compression = _determine_compression_from_header(json_file)
     chunk_iterator = _iterate_archives(
@@ -379,20 +808,11 @@ def index_json_file(
         buffer_size=min_chunk_size,
         compression=compression,
     )
-    for i, (arch, start_offset, end_offset) in enumerate(chunk_iterator):
-        _LOGGER.info('processed %s chunk, offset: %s-%s' % (i, start_offset, end_offset))
-        line_start, line_end = 0, 0
-        with _open_compressed_file(arch, compression, mode='rb') as json_in:
-            for line in json_in:
-                data = json.loads(line.decode(_TEXT_ENCODING))
-                line_start = line_end
-                line_end = line_start + len(line)
-                index = '%s|%s|%s|%s|%s' % (
-                    data[field],
-                    start_offset, end_offset - start_offset,
-                    line_start, line_end - line_start,
-                )
-                output_file.write(index.encode(_TEXT_ENCODING) + _LINE_TERMINATOR)
+    index_data = functools.partial(_index_json_data, field=field)
+    index_chunk = functools.partial(_index_json_chunk, compression=compression, field=field)
+    archives = _read_archives(chunk_iterator)
+    for index in _index_archives(archives, compression, index_data, index_chunk, processes):
+        output_file.write(index)
 
 
 def _batch_iterator(
@@ -400,88 +820,370 @@ def _batch_iterator(
     decode_lines: bool = False,
     batch_size: int = _MAX_RECORDS_PER_BATCH
 ) -> Iterable[List[Any]]:
-    items = []
-    for item in iterator:
+    #
+    # islice pulls each batch from the iterator in C, without a Python-level step per item.
+    #
+    iterator = iter(iterator)
+    while True:
+        items = list(itertools.islice(iterator, batch_size))
+        if not items:
+            return
         if decode_lines:
-            items.append(item.strip().decode(_TEXT_ENCODING))
-        else:
-            items.append(item)
-        if len(items) == batch_size:
-            yield items
-            items = []
-    if items:
+            items = [item.strip().decode(_TEXT_ENCODING) for item in items]
         yield items
 
 
-def _scan_index(keys: Iterable, index_fin: IO[str]) -> Dict[int, list]:
+def _seek_to_key(
+    fin: IO[bytes],
+    key: bytes,
+    fsize: int,
+    delimiter: bytes,
+    low: int = 0,
+) -> None:
+    """Moves the file pointer to the first line of a sorted index with a key not less than key.
+
+    Only the lines from low onwards are searched, so low must be the start of a line.
+    """
+    high = fsize
+    while low < high:
+        fin.seek((low + high) // 2)
+        _start_of_line(fin)
+        line_start = fin.tell()
+        candidate = fin.readline().split(delimiter, 1)[0]
+        if candidate < key:
+            low = fin.tell()
+        else:
+            high = line_start
+    fin.seek(low)
+
+
+def _is_random_access(fin: IO[bytes]) -> bool:
+    """Return True if fin is an uncompressed in-memory or local file.
+
+    Compressed streams like GzipFile claim to be seekable too, but they decompress
+    the stream from the start again for every backward seek, so bisecting them
+    is much slower than reading them once.
+    """
+    if not fin.seekable():
+        return False
+    while isinstance(fin, (io.BufferedReader, io.BufferedRandom)):
+        fin = fin.raw  # type: ignore
+    return isinstance(fin, (io.BytesIO, io.FileIO))
+
+
+def _lookup_index(
+    keys: List[bytes],
+    index_fin: IO[bytes],
+    index_sorted: bool = False,
+) -> Iterable[List[bytes]]:
+    """Yield the rows of an index that match any of the sorted keys."""
+    delimiter = DEFAULT_CSV_DELIMITER.encode(_TEXT_ENCODING)
+    wanted = set(keys)
+    if not index_sorted:
+        if index_fin.seekable():
+            index_fin.seek(0)
+        for line in index_fin:
+            #
+            # Most lines don't match, so only split off the key until one does.
+            #
+            if line.split(delimiter, 1)[0] in wanted:
+                yield line.rstrip(_LINE_TERMINATOR).split(delimiter)
+        return
+
+    fsize = index_fin.seek(0, io.SEEK_END) if _is_random_access(index_fin) else None
+
+    if fsize is not None and len(keys) * _BISECT_COST < fsize:
+        #
+        # A few keys in a large index: bisect the index for each of them.  The keys
+        # are sorted, so each one can only be further down the index than the last.
+        #
+        position = 0
+        for key in keys:
+            _seek_to_key(index_fin, key, fsize, delimiter, low=position)
+            position = index_fin.tell()
+            for line in iter(index_fin.readline, b''):
+                if line.split(delimiter, 1)[0] != key:
+                    break
+                yield line.rstrip(_LINE_TERMINATOR).split(delimiter)
+        return
+
+    if fsize is not None:
+        #
+        # Skip the lines before the smallest key, which matters when the keys are
+        # retrieved in batches: each batch would otherwise read the index from the top.
+        #
+        _seek_to_key(index_fin, keys[0], fsize, delimiter)
+
+    #
+    # Read the index sequentially, stopping as soon as we are past the largest key.
+    #
+    largest = keys[-1]
+    for line in index_fin:
+        key = line.split(delimiter, 1)[0]
+        if key in wanted:
+            yield line.rstrip(_LINE_TERMINATOR).split(delimiter)
+        elif key > largest:
+            break
+
+
+def _scan_index(
+    keys: Iterable[bytes],
+    index_fin: IO[bytes],
+    index_sorted: bool = False,
+) -> Dict[int, list]:
     #
     # Groups indexes by gzip/zstd chunks and filters them.
     #
-    keys_idx = collections.defaultdict(list)
-    keys = set(keys)
-    keys_seen = set()
-    csv_reader = csv.reader(index_fin, delimiter=DEFAULT_CSV_DELIMITER)
-    for row in csv_reader:
-        key, start_offset = row[0], int(row[1])
-        if key in keys:
-            keys_idx[start_offset].append(row)
-            keys_seen.add(key)
-
-    missing_keys = keys - keys_seen
+    # The index is machine-generated, so we split the raw lines instead of
+    # decoding them and running them through a CSV reader.  If it is sorted
+    # by key, we don't have to read all of it.
+    #
+    keys_idx = collections.defaultdict(list)  # type: Dict[int, list]
+    keys = sorted(set(keys))
+    if not keys:
+        return keys_idx
+
+    for row in _lookup_index(keys, index_fin, index_sorted):
+        keys_idx[int(row[1])].append(row)
+
+    missing_keys = set(keys).difference(row[0] for group in keys_idx.values() for row in group)
     if missing_keys:
         _LOGGER.error("Missing keys: %r" % missing_keys)
     return keys_idx
 
 
-class _StreamWrapper:
-    """A custom wrapper that keeps a reference to the current line."""
-
-    def __init__(self, fin, decode_lines=False):
-        self.f = fin
-        self.encode_line = decode_lines
-        self.current_line = None
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        self.current_line = next(self.f)
-        if self.encode_line:
-            return self.current_line.decode(_TEXT_ENCODING)
-        else:
-            return self.current_line
+def _spool(fin: IO[bytes]) -> IO[bytes]:
+    """Copy a stream to a temporary file, and return the rewound temporary file."""
+    fout = tempfile.TemporaryFile(prefix='gzipi')
+    shutil.copyfileobj(fin, fout)
+    fout.seek(0)
+    return cast(IO[bytes], fout)
 
 
 def retrieve(
-    keys_fin: IO[bytes], file_path: str, index_fin: IO[str], output_stream: IO[bytes]
+    keys_fin: Union[IO[bytes], AbstractSet[bytes]],
+    file_path: str,
+    index_fin: IO[bytes],
+    output_stream: IO[bytes],
+    index_sorted: bool = False,
+    transport_params: Optional[dict] = None,
 ) -> None:
     """Retrieve data from an indexed file.
 
-    :param keys_fin: A steam with list of keys to retrieve.
+    :param keys_fin: A binary stream with list of keys to retrieve, or a set of keys as bytes.
+        A set of keys is looked up in a single pass over the index.  A stream is
+        looked up in batches, which keeps memory usage low for huge lists of keys.
     :param file_path: A local S3 path to the file retrieve data from.
-    :param index_fin: A file stream to read index from.
+    :param index_fin: A binary file stream to read index from.
     :param output_stream: A file stream to output results to.
+    :param index_sorted: Whether the index is sorted by key, like the indexes that the
+        command-line tool produces.  Keys are then looked up without reading the whole index.
+    :param transport_params: Optional parameters for reading the file remotely.
     """
-    input_fin = smart_open.open(file_path, 'rb', ignore_ext=True)
-    compression = _determine_compression_from_header(input_fin)
-    for keys in _batch_iterator(keys_fin, decode_lines=True):
-        keys_idx = _scan_index(keys, index_fin)
-        displayed = set()
-        for group in keys_idx.values():
-            index = group[0]
-            start_offset, offset_length = int(index[1]), int(index[2])
-            input_fin.seek(start_offset)
-
-            compressed_chunk = io.BytesIO(input_fin.read(offset_length))
-            with _open_compressed_file(compressed_chunk, compression, mode='rb') as fin:
-                for row in group:
-                    fin.seek(int(row[3]))
-                    domain = row[0]
-                    line = fin.read(int(row[4]))
-                    output_stream.write(line)
-                    if domain in displayed:
-                        _LOGGER.error("multiple matches for %s key")
-                    displayed.add(domain)
+    import smart_open
+
+    if isinstance(keys_fin, (set, frozenset)):
+        batches = [keys_fin]  # type: Iterable[Iterable[bytes]]
+        #
+        # A single batch visits each chunk once, so there is nothing to cache.
+        #
+        cache = None  # type: Optional[_ChunkCache]
+    else:
+        batches = _batch_iterator(map(bytes.strip, keys_fin))
+        cache = _ChunkCache()
+        if not _is_random_access(index_fin):
+            #
+            # Each batch reads the index again, so keep an uncompressed copy of it
+            # that we can rewind and bisect cheaply.
+            #
+            index_fin = _spool(index_fin)
+
+    with contextlib.ExitStack() as stack:
+        #
+        # Chunks on S3 are fetched with range requests of their own, so there is
+        # no stream to open.
+        #
+        input_fin = None  # type: Optional[IO[bytes]]
+        if not file_path.startswith('s3://'):
+            input_fin = stack.enter_context(smart_open.open(
+                file_path, 'rb', ignore_ext=True, transport_params=transport_params,
+            ))
+            #
+            # We read whole chunks at scattered offsets, so readahead past them is wasted.
+            #
+            fadvise(input_fin, 'POSIX_FADV_RANDOM')
+        for keys in batches:
+            keys_idx = _scan_index(keys, index_fin, index_sorted)
+            _retrieve_batch(
+                keys_idx, input_fin, output_stream, cache, file_path, transport_params,
+            )
+
+
+class _ChunkCache:
+    """A least recently used cache of decompressed chunks, bounded by their total size.
+
+    Keys that are streamed in batches often hit the same chunks again in later batches.
+    """
+
+    def __init__(self, max_size: int = _CHUNK_CACHE_SIZE) -> None:
+        self._chunks = collections.OrderedDict()  # type: collections.OrderedDict
+        self._size = 0
+        self._max_size = max_size
+
+    def get(self, start_offset: int) -> Optional[bytes]:
+        chunk = self._chunks.get(start_offset)
+        if chunk is not None:
+            self._chunks.move_to_end(start_offset)
+        return chunk
+
+    def put(self, start_offset: int, chunk: bytes) -> None:
+        if len(chunk) > self._max_size or start_offset in self._chunks:
+            return
+        self._chunks[start_offset] = chunk
+        self._size += len(chunk)
+        while self._size > self._max_size:
+            _, evicted = self._chunks.popitem(last=False)
+            self._size -= len(evicted)
+
+
+def _coalesce_runs(groups: Iterable[list]) -> Iterable[Tuple[List[list], int, int]]:
+    """Merge groups of index rows whose chunks are close together into runs.
+
+    The groups must be sorted by chunk offset.  Yields each run with its start and end offsets.
+    """
+    run = []  # type: List[list]
+    run_start, run_end = 0, 0
+    for group in groups:
+        start_offset, offset_length = int(group[0][1]), int(group[0][2])
+        end_offset = start_offset + offset_length
+        if run and (
+            start_offset - run_end > _MAX_READ_GAP or end_offset - run_start > _MAX_READ_SIZE
+        ):
+            yield run, run_start, run_end
+            run = []
+        if not run:
+            run_start = start_offset
+        run.append(group)
+        run_end = end_offset
+    if run:
+        yield run, run_start, run_end
+
+
+def _fetch_runs(
+    runs: Iterable[Tuple[List[list], int, int]],
+    input_fin: Optional[IO[bytes]],
+    file_path: str = '',
+    transport_params: Optional[dict] = None,
+) -> Iterable[Tuple[List[list], int, bytes]]:
+    """Read the data of each run, from input_fin or, for S3 paths, with range requests."""
+    if not file_path.startswith('s3://'):
+        assert input_fin is not None
+        for run, run_start, run_end in runs:
+            input_fin.seek(run_start)
+            yield run, run_start, input_fin.read(run_end - run_start)
+        return
+
+    #
+    # On S3, each read waits a full round trip, so keep several range requests
+    # in flight at once, as long as their total size stays within budget.  The
+    # results still come back in file order.
+    #
+    with concurrent.futures.ThreadPoolExecutor(_S3_CONCURRENCY) as executor:
+        pending = collections.deque()  # type: collections.deque
+        in_flight = 0
+        for run, run_start, run_end in runs:
+            length = run_end - run_start
+            while pending and (
+                len(pending) >= _S3_CONCURRENCY or in_flight + length > _S3_MAX_IN_FLIGHT
+            ):
+                done_run, done_start, done_length, future = pending.popleft()
+                in_flight -= done_length
+                yield done_run, done_start, future.result()
+            future = executor.submit(_read_range, file_path, run_start, length, transport_params)
+            pending.append((run, run_start, length, future))
+            in_flight += length
+        while pending:
+            run, run_start, _, future = pending.popleft()
+            yield run, run_start, future.result()
+
+
+def _read_chunks(
+    groups: Iterable[list],
+    input_fin: Optional[IO[bytes]],
+    file_path: str = '',
+    transport_params: Optional[dict] = None,
+) -> Iterable[Tuple[list, memoryview]]:
+    """Read the compressed chunk that each group of index rows points to.
+
+    The groups must be sorted by chunk offset.  Chunks that are close together
+    are read in a single request, and then sliced apart.
+    """
+    runs = _coalesce_runs(groups)
+    for run, run_start, data in _fetch_runs(runs, input_fin, file_path, transport_params):
+        #
+        # Hand out views into the run, so that nothing is copied until it is inflated.
+        #
+        view = memoryview(data)
+        for group in run:
+            start_offset = int(group[0][1]) - run_start
+            yield group, view[start_offset:start_offset + int(group[0][2])]
+
+
+def _retrieve_batch(
+    keys_idx: Dict[int, list],
+    input_fin: Optional[IO[bytes]],
+    output_stream: IO[bytes],
+    cache: Optional[_ChunkCache] = None,
+    file_path: str = '',
+    transport_params: Optional[dict] = None,
+) -> None:
+    displayed = set()
+    #
+    # Visit the chunks in file order, so that we only ever seek forward, and fetch
+    # the next few of them while we decompress the current one.  Chunks that an
+    # earlier batch decompressed are not fetched at all.
+    #
+    start_offsets = sorted(keys_idx)
+    cached = {
+        offset: cache.get(offset) if cache is not None else None for offset in start_offsets
+    }
+    missing = [keys_idx[offset] for offset in start_offsets if cached[offset] is None]
+    fetched = _prefetch(_read_chunks(missing, input_fin, file_path, transport_params))
+    #
+    # Stop the prefetching thread before returning, even on error, so that it is
+    # done with input_fin by the time the caller closes it.
+    #
+    with contextlib.closing(fetched):
+        for start_offset in start_offsets:
+            group = keys_idx[start_offset]
+            chunk = cached[start_offset]
+            if chunk is None:
+                _, compressed_chunk = next(fetched)
+                #
+                # Every chunk starts with its own header, so we can tell its compression
+                # without reading the start of the file, which costs another request on S3.
+                #
+                compression = _compression_from_magic(bytes(compressed_chunk[:4]))
+                #
+                # Inflate the whole chunk once.  Seeking backwards in a compressed stream
+                # would otherwise re-inflate it from the start of the chunk for every row.
+                #
+                chunk = _decompress(compressed_chunk, compression)
+                if cache is not None:
+                    cache.put(start_offset, chunk)
+            data = memoryview(chunk)
+            #
+            # Write the lines of a chunk in file order too, as they appear in the data.
+            #
+            group.sort(key=lambda row: int(row[3]))
+            for row in group:
+                line_start = int(row[3])
+                domain = row[0]
+                line = data[line_start:line_start + int(row[4])]
+                output_stream.write(line)
+                if domain in displayed:
+                    _LOGGER.error("multiple matches for %r key", domain)
+                displayed.add(domain)
 
 
 def _start_of_line(
@@ -490,29 +1192,25 @@ def _start_of_line(
     bufsize: int = io.DEFAULT_BUFFER_SIZE
 ) -> None:
     """Moves the file pointer back to the start of the current line."""
-    while True:
-        current_pos = fin.tell()
-        if current_pos == 0:
-            break
-
-        seek_pos = max(0, current_pos - bufsize)
-        fin.seek(seek_pos)
-        buf = fin.read(current_pos - seek_pos)
+    end = fin.tell()
+    while end > 0:
+        start = max(0, end - bufsize)
+        fin.seek(start)
+        buf = fin.read(end - start)
+
+        index = buf.rfind(lineterminator)
+        if index != -1:
+            fin.seek(start + index + 1)
+            return
 
-        assert fin.tell() == current_pos, 'we should be back at current_pos'
+        #
+        # Try again further back, with a larger lookbehind buffer.  There is no
+        # need to read the part we have already searched again.
+        #
+        end = start
+        bufsize *= 2
 
-        if lineterminator in buf:
-            index = max([i for (i, c) in enumerate(buf) if c == ord(lineterminator)])
-            fin.seek(seek_pos + index + 1)
-            break
-        elif bufsize < current_pos:
-            #
-            # Try again with a larger lookbehind buffer.
-            #
-            bufsize *= 2
-        else:
-            fin.seek(0)
-            break
+    fin.seek(0)
 
 
 def _buffer_chunk(
@@ -550,18 +1248,47 @@ def _buffer_chunk(
     return buf, start, end, pivot
 
 
-def _is_last_line(fin: IO[bytes], start: int, end: int) -> bool:
-    current_pos = fin.tell()
-    fin.seek(start)
-    data = fin.read(end - start)
+def _is_last_line(buf: bytes, start: int, end: int, lineterminator: bytes) -> bool:
     #
     # It's possible to be in the middle of two last lines.
     #
-    if data.count(_LINE_TERMINATOR) == 0:
-        return True
+    return buf.find(lineterminator, start, end) == -1
+
+
+def _find_line(
+    key: bytes,
+    buf: Any,
+    start: int,
+    end: int,
+    delimiter: bytes,
+    lineterminator: bytes,
+) -> List[bytes]:
+    """Return the fields after the key on the first line of buf that starts with it.
+
+    Only lines that start within [start, end] are scanned.
+
+    Past the last few probes, one find over a page of data is cheaper than
+    bisecting it line by line.
+    """
+    if delimiter in key:
+        #
+        # The key is the first field of a line, so it can't contain the delimiter.
+        # Searching for it anyway would match a line on its first few fields.
+        #
+        raise KeyError(key)
+    needle = key + delimiter
+    at_line_start = start == 0 or buf[start - 1:start] == lineterminator
+    if at_line_start and buf[start:start + len(needle)] == needle:
+        line_start = start
     else:
-        fin.seek(current_pos)
-        return False
+        line_start = buf.find(lineterminator + needle, start, end + len(needle)) + 1
+        if line_start == 0:
+            raise KeyError(key)
+
+    line_end = buf.find(lineterminator, line_start)
+    if line_end == -1:
+        line_end = len(buf)
+    return buf[line_start + len(needle):line_end].split(delimiter)
 
 
 def _binary_search(
@@ -579,6 +1306,7 @@ def _binary_search(
     if fsize < buffer_size * _BYTES_IN_KiB:
         fin = io.BytesIO(fin.read())
         buffered = True
+        buf = fin.getvalue()
 
     while True:
         #
@@ -588,10 +1316,24 @@ def _binary_search(
         assert (start, pivot, end) not in seen, 'stuck in an infinite loop'
         seen.add((start, pivot, end))
 
-        fin.seek(pivot)
-        _start_of_line(fin)
+        if buffered and end - start <= _LINEAR_SEARCH_SIZE:
+            return _find_line(key, buf, start, end, delimiter, lineterminator)
 
-        line = fin.readline()
+        if buffered:
+            #
+            # The whole scope is in memory, so find both ends of the line in the
+            # buffer itself, without seeking and reading it back out of a stream.
+            #
+            line_start = buf.rfind(lineterminator, 0, pivot) + 1
+            line_end = buf.find(lineterminator, line_start) + 1
+            if line_end == 0:
+                line_end = len(buf)
+            line = buf[line_start:line_end]
+        else:
+            fin.seek(pivot)
+            _start_of_line(fin)
+            line = fin.readline()
+            line_end = fin.tell()
 
         candidate, rest = line.split(delimiter, 1)
         _LOGGER.debug(
@@ -601,12 +1343,12 @@ def _binary_search(
 
         if candidate == key:
             return rest.rstrip(lineterminator).split(delimiter)
-        elif fin.tell() == fsize:
+        elif line_end == fsize:
             #
             # Reached EOF
             #
             raise KeyError(key)
-        elif buffered and fin.tell() > end and _is_last_line(fin, start, end):
+        elif buffered and line_end > end and _is_last_line(buf, start, end, lineterminator):
             raise KeyError(key)
         elif key < candidate:
             start, pivot, end = start, (pivot + start) // 2, pivot
@@ -620,6 +1362,7 @@ def _binary_search(
             #
             fin, start, end, pivot = _buffer_chunk(fin, start, end, pivot, lineterminator)
             buffered = True
+            buf = fin.getvalue()  # type: ignore
 
 
 def _getsize(path: str, transport_params: Optional[dict]) -> int:
@@ -627,18 +1370,278 @@ def _getsize(path: str, transport_params: Optional[dict]) -> int:
 
     Works for both S3 and local objects.
     """
+    import smart_open
+
     with smart_open.open(path, 'rb', ignore_ext=True, transport_params=transport_params) as fin:
         fin.seek(0, io.SEEK_END)
         return fin.tell()
 
 
+def fadvise(fin: IO[bytes], advice_name: str) -> None:
+    """Tell the kernel how we intend to access a local file, where supported.
+
+    POSIX_FADV_SEQUENTIAL enlarges the readahead window, and POSIX_FADV_RANDOM
+    disables it.  POSIX_FADV_DONTNEED drops the file from the page cache once
+    we're done with it.
+
+    :param fin: The file stream to advise on.  Streams without a descriptor are ignored.
+    :param advice_name: The name of the advice constant in the os module.
+    """
+    advice = getattr(os, advice_name, None)
+    if advice is None:
+        return
+    try:
+        os.posix_fadvise(fin.fileno(), 0, 0, advice)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        #
+        # Pipes, closed files and file-like objects without a descriptor.
+        #
+        pass
+
+
+def _is_remote(path: str) -> bool:
+    return '://' in path
+
+
+_METADATA_EXTENSION = '.meta'
+"""The extension of the file that stores the smallest and largest keys of an index."""
+
+_METADATA_ENCODING = 'latin-1'
+"""The encoding of the keys in index metadata files, which maps every byte to a character."""
+
+
+def write_index_metadata(index_path: str) -> None:
+    """Record the smallest and largest keys of a sorted local index in a sibling file.
+
+    search uses them to reject keys outside of the index without searching it.
+
+    :param index_path: The local path to the sorted index file.
+    """
+    if index_path.endswith('.gz'):
+        with _gzip_reader.open(index_path, 'rb') as fin:
+            first_line = last_line = fin.readline()
+            #
+            # We can't seek to the end of a gzip stream, so read through it once,
+            # a block at a time, keeping only the last line.
+            #
+            for block in iter(functools.partial(fin.read, _READ_BUFFER_SIZE), b''):
+                data = last_line + block
+                last_line = data[data.rfind(_LINE_TERMINATOR, 0, len(data) - 1) + 1:]
+    else:
+        with open(index_path, 'rb') as fin:
+            first_line = fin.readline()
+            fsize = fin.seek(0, io.SEEK_END)
+            fin.seek(max(0, fsize - 1))
+            _start_of_line(fin)
+            last_line = fin.readline()
+
+    if not first_line:
+        return
+
+    status = os.stat(index_path)
+    #
+    # Keys are arbitrary bytes.  Latin-1 maps each byte to one character, so it
+    # stores any key in JSON and gets the same bytes back.
+    #
+    metadata = {
+        'min': _index_key(first_line).decode(_METADATA_ENCODING),
+        'max': _index_key(last_line).decode(_METADATA_ENCODING),
+        'size': status.st_size,
+        'mtime_ns': status.st_mtime_ns,
+    }
+    with open(index_path + _METADATA_EXTENSION, 'w') as fout:
+        json.dump(metadata, fout)
+
+
+def has_index_metadata(index_path: str) -> bool:
+    """Return True if a local index has up-to-date metadata.
+
+    The command-line tool writes metadata only for the indexes that it sorted.
+    """
+    return _read_index_metadata(index_path) is not None
+
+
+def _read_index_metadata(index_path: str) -> Optional[dict]:
+    try:
+        with open(index_path + _METADATA_EXTENSION) as fin:
+            metadata = json.load(fin)
+        status = os.stat(index_path)
+    except (OSError, ValueError):
+        return None
+
+    #
+    # Ignore metadata that was written for a different version of the index.
+    #
+    if metadata.get('size') != status.st_size or metadata.get('mtime_ns') != status.st_mtime_ns:
+        return None
+    return metadata
+
+
+def _key_in_range(key: bytes, index_path: str) -> bool:
+    metadata = _read_index_metadata(index_path)
+    if metadata is None:
+        return True
+
+    smallest = metadata['min'].encode(_METADATA_ENCODING)
+    largest = metadata['max'].encode(_METADATA_ENCODING)
+    return smallest <= key <= largest
+
+
+def _decompressed_index_path(index_path: str) -> str:
+    """Return the path to an uncompressed copy of the index, creating it if necessary.
+
+    Uncompressed indexes are returned as is.  The copy lives next to the index,
+    or in the temporary directory if the index is in a directory we can't write to.
+    A small metadata file next to the copy records which version of the index it is of.
+    """
+    if not index_path.endswith('.gz'):
+        return index_path
+
+    try:
+        return _decompress_index(index_path, index_path + '.idx')
+    except OSError as err:
+        if err.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+            raise
+
+    digest = hashlib.sha1(P.abspath(index_path).encode(_TEXT_ENCODING)).hexdigest()
+    return _decompress_index(index_path, P.join(tempfile.gettempdir(), 'gzipi-%s.idx' % digest))
+
+
+def _decompress_index(index_path: str, cache_path: str) -> str:
+    #
+    # Like write_index_metadata, check the size as well as the mtime, which is too
+    # coarse on some filesystems and is preserved when an index is restored.
+    #
+    status = os.stat(index_path)
+    version = {'size': status.st_size, 'mtime_ns': status.st_mtime_ns}
+    version_path = cache_path + _METADATA_EXTENSION
+    try:
+        with open(version_path) as fin:
+            if json.load(fin) == version and P.exists(cache_path):
+                return cache_path
+    except (OSError, ValueError):
+        pass
+
+    #
+    # Write to a temporary file first, so that concurrent searches never see
+    # a partially decompressed index.
+    #
+    handle, tmp_path = tempfile.mkstemp(prefix='gzipi', dir=P.dirname(P.abspath(cache_path)))
+    try:
+        with _gzip_reader.open(index_path, 'rb') as fin, os.fdopen(handle, 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    with open(version_path, 'w') as fout:
+        json.dump(version, fout)
+    return cache_path
+
+
+def _mmap_binary_search(key: bytes, index_path: str) -> Optional[List[bytes]]:
+    with open(_decompressed_index_path(index_path), 'rb') as fin:
+        fsize = os.fstat(fin.fileno()).st_size
+        if fsize == 0:
+            raise KeyError(key)
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            #
+            # Bisection touches a handful of scattered pages, so readahead around
+            # each of them is wasted I/O.  madvise is only available since Python 3.8.
+            #
+            if hasattr(mmap, 'MADV_RANDOM'):
+                mm.madvise(mmap.MADV_RANDOM)
+            return _bisect_index(key, mm)
+
+
+def _bisect_index(
+    key: bytes,
+    buf: Any,
+    delimiter: bytes = DEFAULT_CSV_DELIMITER.encode(_TEXT_ENCODING),
+    lineterminator: bytes = _LINE_TERMINATOR,
+) -> List[bytes]:
+    """Look up a key in a sorted index that is entirely addressable in memory, e.g. mmap.
+
+    Unlike _binary_search, this finds line boundaries with find/rfind on the buffer
+    itself, without seeking or copying any of it into an intermediate buffer.
+    """
+    low, high = 0, len(buf)
+    while high - low > _LINEAR_SEARCH_SIZE:
+        line_start = buf.rfind(lineterminator, 0, (low + high) // 2) + 1
+        key_end = buf.find(delimiter, line_start)
+        line_end = buf.find(lineterminator, line_start)
+        if line_end == -1:
+            line_end = len(buf)
+        if key_end == -1 or key_end > line_end:
+            key_end = line_end
+        if buf[line_start:key_end] < key:
+            low = line_end + 1
+        else:
+            high = line_start
+
+    return _find_line(key, buf, low, high, delimiter, lineterminator)
+
+
+@functools.lru_cache(maxsize=None)
+def _default_s3_client() -> Any:
+    import boto3
+    return boto3.client('s3')
+
+
+def _s3_client(transport_params: Optional[dict] = None) -> Any:
+    #
+    # Creating a client is slow, so reuse the default one across calls.
+    #
+    params = transport_params or {}
+    session = params.get('session')
+    resource_kwargs = params.get('resource_kwargs', {})
+    if session is None and not resource_kwargs:
+        return _default_s3_client()
+
+    import boto3
+    session = session or boto3.Session()
+    return session.client('s3', **resource_kwargs)
+
+
+def _read_range(
+    path: str,
+    offset: int,
+    length: int,
+    transport_params: Optional[dict] = None,
+) -> bytes:
+    """Read length bytes at offset from a local or S3 file."""
+    import smart_open
+
+    if path.startswith('s3://'):
+        #
+        # Fetch exactly the requested range in a single request.  smart_open requests
+        # everything from the offset to the end of the object instead.
+        #
+        bucket, _, key = path[len('s3://'):].partition('/')
+        kwargs = {
+            'Bucket': bucket,
+            'Key': key,
+            'Range': 'bytes=%d-%d' % (offset, offset + length - 1),
+        }
+        version_id = (transport_params or {}).get('version_id')
+        if version_id:
+            kwargs['VersionId'] = version_id
+        response = _s3_client(transport_params).get_object(**kwargs)
+        return response['Body'].read()
+
+    with smart_open.open(path, 'rb', ignore_ext=True, transport_params=transport_params) as fin:
+        fin.seek(offset)
+        return fin.read(length)
+
+
 def search(
     key: bytes,
     file_path: str,
     index_path: str,
     output_stream: IO[bytes],
     buffer_size: int = _DEFAULT_BUFFER_SIZE,
-    transport_params: Optional[dict] = None
+    transport_params: Optional[dict] = None,
+    use_mmap: bool = True,
 ) -> None:
     """Look up a single key in the index, and retrieve the corresponding line.
 
@@ -648,17 +1651,35 @@ def search(
     :param output_stream: The stream to output result to.
     :param buffer_size: The maximum size of the index file chunk to load in memory, in KiB.
     :param transport_params: Optional parameters for reading the files remotely.
+    :param use_mmap: Memory-map local index files instead of reading them through smart_open.
+        Gzipped local indexes are decompressed once to a sibling ``.idx`` file.
     """
-    try:
-        fsize = _getsize(index_path, transport_params=transport_params) # type: ignore
-    except (FileNotFoundError, botocore.exceptions.BotoCoreError) as err:
-        _LOGGER.error("Can't open index file: %s", err)
-        sys.exit(1)
+    import botocore.exceptions
+    import smart_open
 
-    with smart_open.open(index_path, 'rb', transport_params=transport_params) as fin:
-        chunk_offset, chunk_len, line_offset, line_len = _binary_search(
-            key, fin, fsize, buffer_size=buffer_size
-        )  # type: ignore
+    if not _is_remote(index_path) and P.exists(index_path):
+        if not _key_in_range(key, index_path):
+            raise KeyError(key)
+
+    if use_mmap and not _is_remote(index_path):
+        try:
+            chunk_offset, chunk_len, line_offset, line_len = _mmap_binary_search(
+                key, index_path,
+            )  # type: ignore
+        except FileNotFoundError as err:
+            _LOGGER.error("Can't open index file: %s", err)
+            sys.exit(1)
+    else:
+        try:
+            fsize = _getsize(index_path, transport_params=transport_params)  # type: ignore
+        except (FileNotFoundError, botocore.exceptions.BotoCoreError) as err:
+            _LOGGER.error("Can't open index file: %s", err)
+            sys.exit(1)
+
+        with smart_open.open(index_path, 'rb', transport_params=transport_params) as fin:
+            chunk_offset, chunk_len, line_offset, line_len = _binary_search(
+                key, fin, fsize, buffer_size=buffer_size
+            )  # type: ignore
 
     chunk_offset = int(chunk_offset)
     chunk_len = int(chunk_len)
@@ -666,28 +1687,105 @@ def search(
     line_len = int(line_len)
 
     try:
-        fin = smart_open.open(file_path, 'rb', ignore_ext=True, transport_params=transport_params)
-    except (FileNotFoundError, botocore.exceptions.BotoCoreError) as err:
+        compressed_chunk = _read_range(file_path, chunk_offset, chunk_len, transport_params)
+    except (
+        FileNotFoundError,
+        botocore.exceptions.BotoCoreError,
+        botocore.exceptions.ClientError,
+    ) as err:
         _LOGGER.error("Can't open data file: %s", err)
         sys.exit(1)
 
-    with fin:
-        fin.seek(chunk_offset)
-        chunk = io.BytesIO(fin.read(chunk_len))
-        compression = _determine_compression_from_header(fin)
-        with _open_compressed_file(chunk, compression, mode='rb') as inner_fin:
-            inner_fin.seek(line_offset)
-            output_stream.write(inner_fin.read(line_len))
+    #
+    # Inflate the chunk only up to the end of the line, and write the line straight
+    # out of it.  Seeking in a decompressing stream reads and discards a fresh
+    # buffer for every few KiB it skips.
+    #
+    compression = _compression_from_magic(compressed_chunk[:4])
+    data = memoryview(_decompress_head(compressed_chunk, compression, line_offset + line_len))
+    output_stream.write(data[line_offset:line_offset + line_len])
 
 
 def _extract_keys_from_json(line: bytes, field: str) -> str:
-    data = json.loads(line.decode(_TEXT_ENCODING))
+    data = _json_loads(line)
     return data[field]
 
 
-def _extract_keys_from_csv(line: bytes, column: str, delimiter: str) -> str:
-    reader = csv.reader(io.StringIO(line.decode(_TEXT_ENCODING)), delimiter=delimiter)
-    return next(reader)[column]  # type: ignore
+def _extract_keys_from_csv(line: bytes, column: int, delimiter: bytes) -> bytes:
+    if _CSV_QUOTE_CHAR not in line:
+        #
+        # Like index_csv_file, split unquoted lines directly.
+        #
+        return _split_key(line, column, delimiter)
+    reader = csv.reader(
+        io.StringIO(line.decode(_TEXT_ENCODING)), delimiter=delimiter.decode(_TEXT_ENCODING),
+    )
+    return next(reader)[column].encode(_TEXT_ENCODING)
+
+
+def _ordered_map(func: Callable, iterable: Iterable, processes: int) -> Iterable:
+    """Like map, but calls func in a pool of worker processes.
+
+    Results are yielded in the order of the input.  Only a few tasks per worker
+    are in flight at any time, so the input is never read far ahead of the output.
+    Inputs of a single item are handled in this process, since starting a pool
+    would cost more than it saves.  Workers don't fork from this process, so scripts
+    that use more than one must guard their entry point with ``if __name__ == '__main__'``.
+    """
+    iterator = iter(iterable)
+    head = list(itertools.islice(iterator, 2))
+    if processes <= 1 or len(head) < 2:
+        yield from map(func, itertools.chain(head, iterator))
+        return
+
+    with _POOL_CONTEXT.Pool(processes) as pool:
+        pending = collections.deque()  # type: collections.deque
+        for item in itertools.chain(head, iterator):
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+@functools.lru_cache(maxsize=None)
+def _zstd_compressor() -> zstandard.ZstdCompressor:
+    #
+    # Compression contexts are expensive to set up, so each process reuses one.
+    #
+    return zstandard.ZstdCompressor()
+
+
+def _compress(data: bytes, compression: str) -> bytes:
+    """Compress data into a single, self-contained gzip member or zstd frame."""
+    if compression == Compression.GZIP.value:
+        return gzip.compress(data)
+    elif compression == Compression.ZSTD.value:
+        compressor = _zstd_compressor().compressobj()
+        return compressor.compress(data) + compressor.flush()
+    raise NotImplementedError('Unsupported compression format: %s' % compression)
+
+
+def _compress_batch(
+    batch: bytes,
+    extractor: Callable,
+    output_compression: str,
+) -> Tuple[bytes, List[bytes]]:
+    #
+    # The offsets of the chunk are only known once the previous chunks are written,
+    # so we leave a gap for them between each key and the offsets of its line.
+    # Joining the parts with the chunk offsets then yields all the index lines at once.
+    #
+    index_parts = []
+    line_index = b''
+    line_start = 0
+    for line in io.BytesIO(batch):
+        index_parts.append(line_index + _encode_key(extractor(line)))
+        line_index = b'|%d|%d\n' % (line_start, len(line))
+        line_start += len(line)
+    index_parts.append(line_index)
+
+    return _compress(batch, output_compression), index_parts
 
 
 def _repack(
@@ -697,74 +1795,167 @@ def _repack(
     chunk_size: int,
     extractor: Callable,
     output_compression: str = Compression.GZIP.value,
+    processes: int = 1,
 ) -> None:
     start_offset, end_offset = 0, 0
     compressed_chunk = None
     compression = _determine_compression_from_header(fin)
-    assert compression in SUPPORTED_COMPRESSIONS
     assert output_compression in SUPPORTED_COMPRESSIONS
+    if compression == Compression.NONE.value and not fin.read(1):
+        #
+        # An empty input has no header to tell its compression by, and nothing
+        # to decompress, so go straight to writing the empty output.
+        #
+        fout.write(_compress(b'', output_compression))
+        return
+    assert compression in SUPPORTED_COMPRESSIONS
 
+    #
+    # Each batch is compressed independently, so we compress them in parallel.
+    # The results come back in order, which keeps the offsets deterministic.
+    #
+    compress = functools.partial(
+        _compress_batch, extractor=extractor, output_compression=output_compression,
+    )
     with _open_compressed_file(fin, compression, mode='rb') as fin:
-        for batch in _batch_iterator(fin, decode_lines=False, batch_size=chunk_size):
-            keys = []
-            line_indexes = []
-            chunk = io.BytesIO()
-            compressed_chunk = _open_compressed_file(chunk, output_compression, mode='wb')
-
-            line_start, line_end = 0, 0
-            for line in batch:
-                key = extractor(line)
-                keys.append(key)
-                line_start = line_end
-                line_end = line_start + len(line)
-                line_indexes.append('|%s|%s' % (line_start, line_end - line_start))
-                compressed_chunk.write(line)
-
-            compressed_chunk.close()
-            fout.write(chunk.getvalue())
-            fout.flush()
+        #
+        # Hand each batch to the workers as a single byte string: it pickles several
+        # times faster than a list of lines, and the workers split it again cheaply.
+        #
+        batches = map(b''.join, _batch_iterator(fin, decode_lines=False, batch_size=chunk_size))
+        #
+        # Each chunk and its index lines go out in a single write.  We leave flushing
+        # to the caller, since flushing every chunk costs a syscall for each one.
+        #
+        for compressed_chunk, index_parts in _ordered_map(compress, batches, processes):
+            fout.write(compressed_chunk)
 
             start_offset = end_offset
-            end_offset = start_offset + chunk.getbuffer().nbytes
-            for i, key in enumerate(keys):
-                index = '%s|%s|%s' % (key, start_offset, end_offset - start_offset)
-                index += line_indexes[i]
-                index_fout.write(index.encode(_TEXT_ENCODING) + _LINE_TERMINATOR)
-            index_fout.flush()
+            end_offset = start_offset + len(compressed_chunk)
+            chunk_index = b'|%d|%d' % (start_offset, end_offset - start_offset)
+            index_fout.write(chunk_index.join(index_parts))
 
     if compressed_chunk is None:
         #
-        # The input file contained no data.  We must write an empty gzip chunk
-        # to make sure the output file is gzip-readable.
+        # The input file contained no data.  We must write an empty chunk
+        # to make sure the output file is readable.
         #
-        fout = io.BytesIO()
-        zstandard.open(fout, mode='wb').write(b'').close()
-        fout.write(fout.getvalue())
-        fout.flush()
+        fout.write(_compress(b'', output_compression))
+
+
+def _index_key(line: bytes) -> bytes:
+    return line.split(b'|', 1)[0]
+
 
+class ExternalSortWriter:
+    """A binary file-like object that sorts index lines by key as they are written.
 
-def sort_file(file_path: str) -> None:
+    Lines are sorted in memory in runs of up to ``run_size`` lines.  Full runs
+    are spilled to temporary files, which are merged into the underlying stream
+    on close.  This produces the same result as writing the index and then
+    calling :func:`sort_file`, but without a second pass over the index.
+
+    Closing the writer closes the underlying stream.
+    """
+
+    def __init__(self, fout: IO[bytes], run_size: int = _SORT_RUN_SIZE) -> None:
+        self._fout = fout
+        self._run_size = run_size
+        self._lines = []  # type: List[bytes]
+        self._runs = []  # type: List[IO[bytes]]
+        self._partial_line = b''
+
+    def write(self, data: bytes) -> int:
+        lines = (self._partial_line + data).split(_LINE_TERMINATOR)
+        self._partial_line = lines.pop()
+        self._lines.extend(line + _LINE_TERMINATOR for line in lines)
+        if len(self._lines) >= self._run_size:
+            self._spill()
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def _spill(self) -> None:
+        self._lines.sort(key=_index_key)
+        run = tempfile.TemporaryFile(prefix='gzipi')
+        run.writelines(self._lines)
+        run.seek(0)
+        self._runs.append(run)
+        self._lines = []
+
+    def close(self) -> None:
+        if self._partial_line:
+            self._lines.append(self._partial_line + _LINE_TERMINATOR)
+            self._partial_line = b''
+
+        if self._runs:
+            if self._lines:
+                self._spill()
+            self._fout.writelines(heapq.merge(*self._runs, key=_index_key))
+            for run in self._runs:
+                run.close()
+            self._runs = []
+        else:
+            self._lines.sort(key=_index_key)
+            self._fout.writelines(self._lines)
+            self._lines = []
+
+        self._fout.close()
+
+    def __enter__(self) -> 'ExternalSortWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def sort_file(file_path: str, threads: int = _CPU_COUNT) -> None:
     """Sort a file using GNU toolchain.
 
+    Small files, and any file when GNU sort is not available, are sorted in memory.
+
     :param file_path: The path to file to sort.
+    :param threads: The number of threads for sort and pigz to use.
     """
+    if os.path.getsize(file_path) < _IN_MEMORY_SORT_SIZE:
+        return _sort_file_in_memory(file_path)
+
+    import plumbum
+
+    sort_exe = get_exe('gsort', 'sort')
+    if sort_exe is None:
+        _LOGGER.warning('sort executable not found, sorting %s in memory', file_path)
+        return _sort_file_in_memory(file_path)
+
     sorted_handle, tmp_path = tempfile.mkstemp(prefix='gzipi')
     os.close(sorted_handle)
     shutil.move(file_path, tmp_path)
 
     #
     # We use sort from GNU toolchain here, because index file can be pretty big.
+    # pigz parallelizes (de)compression across cores, so prefer it over gzip.
+    #
+    #
+    # --stable keeps rows with the same key in file order, like the in-memory and
+    # external sorts do.  Otherwise, sort would order them by the whole line.
     #
     sort_flags = [
         '--field-separator=|',
         '--key=1,1',
-        '--parallel=%s' % _SORT_CPU_COUNT,
+        '--stable',
+        '--parallel=%s' % threads,
         '--buffer-size=%s' % _SORT_BUFFER_SIZE
     ]
-    gzcat = plumbum.local[get_exe('gzcat', 'zcat')][tmp_path]
+    pigz_exe = get_exe('pigz')
+    if pigz_exe:
+        gzcat = plumbum.local[pigz_exe]['--decompress', '--stdout', tmp_path]
+        gzip_exe = plumbum.local[pigz_exe]['--stdout', '--processes', threads]
+    else:
+        gzcat = plumbum.local[get_exe('gzcat', 'zcat')][tmp_path]
+        gzip_exe = plumbum.local['gzip']['--stdout']
     cat = plumbum.local['cat'][tmp_path]
-    gzip_exe = plumbum.local['gzip']['--stdout']
-    sort = plumbum.local[get_exe('gsort', 'sort')][sort_flags]
+    sort = plumbum.local[sort_exe][sort_flags]
 
     file_path = os.path.abspath(file_path)
     is_gzipped = file_path.endswith('.gz')
@@ -779,6 +1970,24 @@ def sort_file(file_path: str) -> None:
             os.remove(tmp_path)
 
 
+def _sort_file_in_memory(file_path: str) -> None:
+    #
+    # Compare raw bytes of the key column, like LC_ALL=C sort --key=1,1 does.
+    #
+    compression = Compression.GZIP.value if file_path.endswith('.gz') else Compression.NONE.value
+    with _open_compressed_file(file_path, compression, mode='rb') as fin:
+        lines = fin.readlines()
+
+    if lines and not lines[-1].endswith(_LINE_TERMINATOR):
+        lines[-1] += _LINE_TERMINATOR
+
+    delimiter = DEFAULT_CSV_DELIMITER.encode(_TEXT_ENCODING)
+    lines.sort(key=lambda line: line.split(delimiter, 1)[0])
+
+    with _open_compressed_file(file_path, compression, mode='wb') as fout:
+        fout.writelines(lines)
+
+
 def repack_json_file(
     fin: IO[bytes],
     fout: IO[bytes],
@@ -786,6 +1995,7 @@ def repack_json_file(
     chunk_size: int,
     field: str = DEFAULT_JSON_FIELD,
     output_compression: str = Compression.GZIP.value,
+    processes: int = 1,
 ) -> None:
     """Repack a JSON file.
 
@@ -795,9 +2005,10 @@ def repack_json_file(
     :param chunk_size: The number of lines to include in each chunk.
     :param field: The field to use when creating the index.
     :param output_compression: The compression format of the output file. Supports gzip and zstd.
+    :param processes: The number of worker processes to compress chunks with.
     """
     extractor = functools.partial(_extract_keys_from_json, field=field)
-    return _repack(fin, fout, index_fout, chunk_size, extractor, output_compression)
+    return _repack(fin, fout, index_fout, chunk_size, extractor, output_compression, processes)
 
 
 def repack_csv_file(
@@ -808,6 +2019,7 @@ def repack_csv_file(
     column: int = DEFAULT_CSV_COLUMN,
     delimiter: str = DEFAULT_CSV_DELIMITER,
     output_compression: str = Compression.GZIP.value,
+    processes: int = 1,
 ) -> None:
     """Repack a CSV file.
 
@@ -818,9 +2030,12 @@ def repack_csv_file(
     :param column: The index of the column to use when creating the index.
     :param delimiter: The CSV column delimiter.
     :param output_compression: The compression format of the output file. Supports gzip and zstd.
+    :param processes: The number of worker processes to compress chunks with.
     """
-    extractor = functools.partial(_extract_keys_from_csv, column=column, delimiter=delimiter)
-    return _repack(fin, fout, index_fout, chunk_size, extractor, output_compression)
+    extractor = functools.partial(
+        _extract_keys_from_csv, column=column, delimiter=delimiter.encode(_TEXT_ENCODING),
+    )
+    return _repack(fin, fout, index_fout, chunk_size, extractor, output_compression, processes)
 
 
 def get_exe(*preference) -> Optional[str]:
@@ -829,7 +2044,7 @@ def get_exe(*preference) -> Optional[str]:
     The list should be in order of decreasing preference.
     """
     for exe in preference:
-        path = distutils.spawn.find_executable(exe)
+        path = shutil.which(exe)
         if path:
             return path
     return None
@@ -23,7 +23,7 @@ def test_indexes_json_file():
 def test_retrieves_indexed_json():
     curr_dir = P.dirname(P.abspath(__file__))
     json_path = P.join(curr_dir,  'data/sample.json.gz')
-    index_fin = gzip.open(P.join(curr_dir, 'data/index.json.gz'), 'rt')
+    index_fin = gzip.open(P.join(curr_dir, 'data/index.json.gz'), 'rb')
     keys = io.BytesIO(
         b"95-926-1252\n00-720-2041"
         b"\n17-517-6091\n06-589-6091\n37-510-3515"
@@ -46,10 +46,28 @@ def test_indexes_csv_file():
     assert expected == actual
 
 
+def test_indexes_csv_file_in_parallel():
+    curr_dir = P.dirname(P.abspath(__file__))
+    repacked_file, repacked_index = io.BytesIO(), io.BytesIO()
+    with open(P.join(curr_dir,  'data/sample.csv.gz'), 'rb') as fin:
+        gzipi.lib.repack_csv_file(fin, repacked_file, repacked_index, 100, delimiter=',')
+
+    outputs = []
+    for processes in (1, 3):
+        output_file = io.BytesIO()
+        gzipi.lib.index_csv_file(
+            io.BytesIO(repacked_file.getvalue()), output_file, column=0, delimiter=',',
+            min_chunk_size=1000, processes=processes,
+        )
+        outputs.append(output_file.getvalue())
+    assert outputs[0] == outputs[1]
+    assert outputs[0].count(b'\n') == repacked_index.getvalue().count(b'\n')
+
+
 def test_retrieves_indexed_csv():
     curr_dir = P.dirname(P.abspath(__file__))
     json_path = P.join(curr_dir,  'data/sample.csv.gz')
-    index_fin = gzip.open(P.join(curr_dir, 'data/index.csv.gz'), 'rt')
+    index_fin = gzip.open(P.join(curr_dir, 'data/index.csv.gz'), 'rb')
     keys = io.BytesIO(
         b"56-053-2131\n09-530-5619"
         b"\n25-172-0048\n11-111-1148\n20-429-6275"
@@ -62,8 +80,64 @@ def test_retrieves_indexed_csv():
     assert expected == actual
 
 
+def test_retrieves_indexed_csv_from_key_set():
+    curr_dir = P.dirname(P.abspath(__file__))
+    csv_path = P.join(curr_dir,  'data/sample.csv.gz')
+    index_fin = gzip.open(P.join(curr_dir, 'data/index.csv.gz'), 'rb')
+    keys = frozenset([
+        b'56-053-2131', b'09-530-5619', b'25-172-0048', b'11-111-1148', b'20-429-6275',
+    ])
+    output_file = io.BytesIO()
+
+    gzipi.lib.retrieve(keys, csv_path, index_fin, output_file)
+    actual = output_file.getvalue()
+    expected = open(P.join(curr_dir,  'data/retrieve_expected.csv'), 'rb').read()
+    assert expected == actual
+
+
+def test_retrieves_indexed_csv_in_batches():
+    curr_dir = P.dirname(P.abspath(__file__))
+    csv_path = P.join(curr_dir,  'data/sample.csv.gz')
+    index_fin = gzip.open(P.join(curr_dir, 'data/index.csv.gz'), 'rb')
+    #
+    # Push the keys we are after past the first batch.
+    #
+    missing = b''.join(b'missing-%d\n' % i for i in range(gzipi.lib._MAX_RECORDS_PER_BATCH))
+    keys = io.BytesIO(
+        missing + b"56-053-2131\n09-530-5619"
+        b"\n25-172-0048\n11-111-1148\n20-429-6275"
+    )
+    output_file = io.BytesIO()
+
+    gzipi.lib.retrieve(keys, csv_path, index_fin, output_file)
+    actual = output_file.getvalue()
+    expected = open(P.join(curr_dir,  'data/retrieve_expected.csv'), 'rb').read()
+    assert expected == actual
+
+
+def test_retrieves_from_sorted_index_in_file_order():
+    curr_dir = P.dirname(P.abspath(__file__))
+    csv_path = P.join(curr_dir,  'data/sample.csv.gz')
+    with gzip.open(P.join(curr_dir, 'data/index.csv.gz'), 'rb') as fin:
+        lines = sorted(fin, key=lambda line: line.split(b'|', 1)[0])
+    index_fin = io.BytesIO(b''.join(lines))
+    keys = frozenset([
+        b'56-053-2131', b'09-530-5619', b'25-172-0048', b'11-111-1148', b'20-429-6275',
+    ])
+    output_file = io.BytesIO()
+
+    gzipi.lib.retrieve(keys, csv_path, index_fin, output_file, index_sorted=True)
+    actual = output_file.getvalue()
+    expected = open(P.join(curr_dir,  'data/retrieve_expected.csv'), 'rb').read()
+    assert expected == actual
+
+
 if __name__ == '__main__':
     test_indexes_json_file()
     test_retrieves_indexed_json()
     test_indexes_csv_file()
+    test_indexes_csv_file_in_parallel()
     test_retrieves_indexed_csv()
+    test_retrieves_indexed_csv_from_key_set()
+    test_retrieves_indexed_csv_in_batches()
+    test_retrieves_from_sorted_index_in_file_order()
@@ -67,7 +67,29 @@ def test_repacks_csv_zst_file():
     assert fout.getvalue().count(gzipi.lib._ZSTD_HEADER) == 21
 
 
+def test_repacks_csv_file_in_parallel():
+    curr_dir = P.dirname(P.abspath(__file__))
+    results = []
+    for processes in (1, 3):
+        csv_file = open(P.join(curr_dir, 'data/sample.csv.gz'), 'rb')
+        fout = io.BytesIO()
+        index_fout = io.BytesIO()
+        gzipi.lib.repack_csv_file(
+            fin=csv_file,
+            fout=fout,
+            index_fout=index_fout,
+            chunk_size=50,
+            column=0,
+            delimiter=',',
+            processes=processes,
+        )
+        results.append(index_fout.getvalue())
+    expected_index = gzip.open(P.join(curr_dir, 'data/repacked_index.csv.gz'), 'rb').read()
+    assert results == [expected_index, expected_index]
+
+
 if __name__ == '__main__':
     test_repacks_json_file()
     test_repacks_csv_file()
     test_repacks_csv_zst_file()
+    test_repacks_csv_file_in_parallel()
@@ -16,6 +16,7 @@ version = read('gzipi/VERSION').split('\n')[0]
 requirements = ['smart-open', 'plumbum', 'zstandard', ]
 setup_requirements = []
 test_requirements = ['pytest', 'flake8', ]
+extras_requirements = {'fast': ['isal', 'orjson']}
 
 setup(
     author="Profound Networks",
@@ -33,6 +34,7 @@ setup(
         'Programming Language :: Python :: 3.8',
     ],
     install_requires=requirements,
+    extras_require=extras_requirements,
     include_package_data=True,
     package_data={
         'gzipi': [
@@ -4,16 +4,19 @@
 #
 import gzip
 import io
+import os
+import os.path as P
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock as mock
 
 import gzipi.lib
 
 
 def _gzip_data(data):
-    buf = io.BytesIO()
-    with gzip.GzipFile(fileobj=buf, mode='w') as fout:
-        fout.write(data)
-    return buf.getvalue()
+    return gzip.compress(data)
 
 
 class IterateArchivestest(unittest.TestCase):
@@ -29,11 +32,207 @@ class IterateArchivestest(unittest.TestCase):
         buf.flush()
         buf.seek(0)
         expected = [(chunks[0], 0, 37), (chunks[1], 37, 68), (chunks[2], 68, 101)]
-        actual = [
-            (chunk[0].getvalue(), chunk[1], chunk[2])
-            for chunk in gzipi.lib._iterate_archives(buf, buffer_size=15)
-        ]
+        actual = list(gzipi.lib._iterate_archives(buf, buffer_size=15))
+        self.assertEqual(expected, actual)
+
+    def test_skips_invalid_headers(self):
+        #
+        # The second chunk ends with the gzip magic bytes, but not with a valid header.
+        #
+        fake_header = b'\x1f\x8b\x08' + b'\0' * 7
+        chunks = [_gzip_data(b'chunk number 1'), _gzip_data(b'chunk  #2') + fake_header]
+        buf = io.BytesIO(b''.join(chunks))
+        expected = [(chunks[0], 0, 34), (chunks[1], 34, 73)]
+        actual = list(gzipi.lib._iterate_archives(buf, buffer_size=100))
+        self.assertEqual(expected, actual)
+
+    def test_iterates_mapped_file(self):
+        chunks = [_gzip_data(b'chunk number 1'), _gzip_data(b'chunk  #2' * 2)]
+        with tempfile.TemporaryFile() as fin:
+            fin.write(b''.join(chunks))
+            fin.seek(0)
+            expected = [(chunks[0], 0, 34), (chunks[1], 34, 65)]
+            actual = list(gzipi.lib._iterate_archives(fin, buffer_size=15))
+        self.assertEqual(expected, actual)
+
+
+class IsValidGzipHeaderTest(unittest.TestCase):
+    def test_validates_header_at_offset(self):
+        buf = b'junk' + _gzip_data(b'data')
+        self.assertTrue(gzipi.lib._is_valid_gzip_header(buf, 4))
+        self.assertFalse(gzipi.lib._is_valid_gzip_header(buf, 0))
+
+    def test_rejects_future_timestamp(self):
+        buf = _gzip_data(b'data')
+        self.assertFalse(gzipi.lib._is_valid_gzip_header(buf, now=0))
+
+    def test_accepts_members_written_while_reading(self):
+        buf = _gzip_data(b'data')
+        self.assertTrue(gzipi.lib._is_valid_gzip_header(buf, now=time.time() - 60))
+
+
+class DecompressHeadTest(unittest.TestCase):
+    def test_decompresses_only_the_head(self):
+        data = b'0123456789' * 1000
+        compressed = {
+            'gzip': gzip.compress(data),
+            'zstd': gzipi.lib._compress(data, 'zstd'),
+            None: data,
+        }
+        for compression, chunk in compressed.items():
+            actual = gzipi.lib._decompress_head(chunk, compression, 15)
+            self.assertEqual(data[:15], actual)
+
+
+class IterateBlocksTest(unittest.TestCase):
+    def test_iterates_uncompressed_blocks_of_complete_lines(self):
+        buf = io.BytesIO(b'one\ntwo\nthree\nfour')
+        expected = [(b'one\ntwo\n', 0, 8), (b'three\n', 8, 14), (b'four', 14, 18)]
+        actual = list(gzipi.lib._iterate_archives(buf, buffer_size=5, compression=None))
+        self.assertEqual(expected, actual)
+
+
+class IndexCsvDataTest(unittest.TestCase):
+    def test_indexes_quoted_record_spanning_lines(self):
+        data = b'a,"one\ntwo"\nb,three\n'
+        expected = b'a|10|5|0|12\nb|10|5|12|8\n'
+        actual = gzipi.lib._index_csv_data((data, 10, 15), column=0, delimiter=',')
+        self.assertEqual(expected, actual)
+
+    def test_indexes_last_column(self):
+        data = b'a,x\r\nb,y\n'
+        expected = b'x|10|5|0|5\ny|10|5|5|4\n'
+        actual = gzipi.lib._index_csv_data((data, 10, 15), column=1, delimiter=',')
+        self.assertEqual(expected, actual)
+
+
+class JsonLoadsTest(unittest.TestCase):
+    def test_parses_what_json_parses(self):
+        actual = gzipi.lib._json_loads(b'{"a": NaN, "b": 123456789012345678901234567890}')
+        self.assertNotEqual(actual['a'], actual['a'])
+        self.assertEqual(123456789012345678901234567890, actual['b'])
+
+    def test_rejects_invalid_json(self):
+        with self.assertRaises(ValueError):
+            gzipi.lib._json_loads(b'{"a": ')
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_yields_items_in_order(self):
+        self.assertEqual(list(range(10)), list(gzipi.lib._prefetch(range(10), size=2)))
+
+    def test_reraises_errors(self):
+        def fail():
+            yield 1
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            list(gzipi.lib._prefetch(fail()))
+
+    def test_stops_thread_on_close(self):
+        threads = []
+
+        def produce():
+            threads.append(threading.current_thread())
+            while True:
+                yield 1
+
+        items = gzipi.lib._prefetch(produce(), size=1)
+        self.assertEqual(1, next(items))
+        items.close()
+        self.assertFalse(threads[0].is_alive())
+
+
+class ReadChunksTest(unittest.TestCase):
+    def test_coalesces_nearby_chunks(self):
+        seeks = []
+
+        class Stream(io.BytesIO):
+            def seek(self, *args):
+                seeks.append(args[0])
+                return super().seek(*args)
+
+        groups = [[[b'a', b'0', b'2']], [[b'b', b'3', b'2']], [[b'c', b'8', b'2']]]
+        with mock.patch.object(gzipi.lib, '_MAX_READ_GAP', 1):
+            actual = list(gzipi.lib._read_chunks(groups, Stream(b'0123456789')))
+        expected = [(groups[0], b'01'), (groups[1], b'34'), (groups[2], b'89')]
         self.assertEqual(expected, actual)
+        self.assertEqual([0, 8], seeks)
+
+    def test_reads_s3_ranges_concurrently(self):
+        data = b'0123456789'
+        groups = [[[b'a', b'0', b'2']], [[b'b', b'8', b'2']]]
+        with mock.patch.object(gzipi.lib, '_MAX_READ_GAP', 1), \
+                mock.patch.object(gzipi.lib, '_read_range') as read_range:
+            read_range.side_effect = lambda path, offset, length, params: \
+                data[offset:offset + length]
+            actual = list(gzipi.lib._read_chunks(groups, None, 's3://bucket/key'))
+        self.assertEqual([(groups[0], b'01'), (groups[1], b'89')], actual)
+        self.assertEqual(2, read_range.call_count)
+
+    def test_limits_s3_bytes_in_flight(self):
+        data = b'0123456789'
+        groups = [[[b'a', b'0', b'4']], [[b'b', b'6', b'4']]]
+        params = {'session': 'x'}
+        with mock.patch.object(gzipi.lib, '_MAX_READ_GAP', 1), \
+                mock.patch.object(gzipi.lib, '_S3_MAX_IN_FLIGHT', 5), \
+                mock.patch.object(gzipi.lib, '_read_range') as read_range:
+            read_range.side_effect = lambda path, offset, length, params: \
+                data[offset:offset + length]
+            chunks = gzipi.lib._read_chunks(groups, None, 's3://bucket/key', params)
+            self.assertEqual((groups[0], b'0123'), next(chunks))
+            #
+            # The second range doesn't fit in the budget until the first one is done.
+            #
+            self.assertEqual(1, read_range.call_count)
+            self.assertEqual((groups[1], b'6789'), next(chunks))
+        read_range.assert_called_with('s3://bucket/key', 6, 4, params)
+
+
+class RetrieveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = P.join(self.tmpdir.name, 'data.csv.gz')
+        data = gzip.compress(b'a,1\nb,2\n')
+        with open(self.path, 'wb') as fout:
+            fout.write(data)
+        self.index = b'a|0|%d|0|4\nb|0|%d|4|4\n' % (len(data), len(data))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _retrieve(self, keys):
+        output = io.BytesIO()
+        gzipi.lib.retrieve(keys, self.path, io.BytesIO(self.index), output, index_sorted=True)
+        return output.getvalue()
+
+    def test_key_set_skips_chunk_cache(self):
+        with mock.patch.object(gzipi.lib, '_ChunkCache') as chunk_cache:
+            self.assertEqual(b'b,2\n', self._retrieve(frozenset([b'b'])))
+        chunk_cache.assert_not_called()
+
+    def test_key_stream_uses_chunk_cache(self):
+        chunk_cache = gzipi.lib._ChunkCache
+        with mock.patch.object(gzipi.lib, '_ChunkCache', wraps=chunk_cache) as chunk_cache:
+            self.assertEqual(b'a,1\nb,2\n', self._retrieve(io.BytesIO(b'a\nb\n')))
+        chunk_cache.assert_called_once_with()
+
+
+class ChunkCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used_chunks(self):
+        cache = gzipi.lib._ChunkCache(max_size=4)
+        cache.put(0, b'aa')
+        cache.put(10, b'bb')
+        cache.get(0)
+        cache.put(20, b'cc')
+        self.assertEqual(b'aa', cache.get(0))
+        self.assertIsNone(cache.get(10))
+        self.assertEqual(b'cc', cache.get(20))
+
+    def test_skips_oversized_chunks(self):
+        cache = gzipi.lib._ChunkCache(max_size=1)
+        cache.put(0, b'aa')
+        self.assertIsNone(cache.get(0))
 
 
 class StartOfLineTest(unittest.TestCase):
@@ -64,6 +263,15 @@ class StartOfLineTest(unittest.TestCase):
         actual = self.fin.readline()
         self.assertEqual(expected, actual)
 
+    def test_long_line(self):
+        self.fin = io.BytesIO(b'one\n' + b'x' * 100)
+        self.fin.read()
+        gzipi.lib._start_of_line(self.fin, bufsize=3)
+
+        expected = b'x' * 100
+        actual = self.fin.readline()
+        self.assertEqual(expected, actual)
+
 
 class BinarySearchTest(unittest.TestCase):
     def setUp(self):
@@ -101,6 +309,22 @@ class BinarySearchTest(unittest.TestCase):
         with self.assertRaises(KeyError):
             gzipi.lib._binary_search(b'key33', fin, self.fsize)
 
+    def test_key_with_delimiter(self):
+        fin = io.BytesIO(b'a|0|10|0|5\n')
+        with self.assertRaises(KeyError):
+            gzipi.lib._binary_search(b'a|0', fin, len(fin.getvalue()))
+
+    def test_bisects_index_larger_than_a_page(self):
+        lines = [b'%06d|%d\n' % (i, i) for i in range(0, 20000, 2)]
+        fin = io.BytesIO(b''.join(lines))
+        fsize = len(fin.getvalue())
+        for i in (0, 2, 1000, 9998, 19998):
+            actual = gzipi.lib._binary_search(b'%06d' % i, fin, fsize, buffer_size=16)
+            self.assertEqual([b'%d' % i], actual)
+        for key in (b'000001', b'009999', b'099999'):
+            with self.assertRaises(KeyError):
+                gzipi.lib._binary_search(key, fin, fsize, buffer_size=16)
+
 
 class BufferChunkTest(unittest.TestCase):
     def setUp(self):
@@ -141,3 +365,248 @@ class RepackEmptyTest(unittest.TestCase):
     def test_json_contains_gzip_header(self):
         gzipi.lib.repack_json_file(self.fin, self.fout, self.index_fout, 1000)
         self.assertEqual(self.fout.getvalue(), self.gzip_header)
+
+    def test_compressed_empty_input(self):
+        fin = io.BytesIO(gzip.compress(b''))
+        gzipi.lib.repack_csv_file(fin, self.fout, self.index_fout, 1000)
+        self.assertEqual(gzip.decompress(self.fout.getvalue()), b'')
+        self.assertEqual(self.index_fout.getvalue(), b'')
+
+
+class SortFileInMemoryTest(unittest.TestCase):
+    def test_sorts_gzipped_index_by_key(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = P.join(tmpdir, 'index.gz')
+            with gzip.open(path, 'wb') as fout:
+                fout.write(b'c|1\na|2\nb|3')
+            gzipi.lib._sort_file_in_memory(path)
+            with gzip.open(path, 'rb') as fin:
+                self.assertEqual(fin.read(), b'a|2\nb|3\nc|1\n')
+
+
+class SortFileTest(unittest.TestCase):
+    def setUp(self):
+        self.data = b'b|9\na|3\nb|1\nc|0\na|2\nb|5\n'
+        self.expected = b'a|3\na|2\nb|9\nb|1\nb|5\nc|0\n'
+
+    def _sort_file(self, in_memory_sort_size):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = P.join(tmpdir, 'index.gzi')
+            with open(path, 'wb') as fout:
+                fout.write(self.data)
+            with mock.patch.object(gzipi.lib, '_IN_MEMORY_SORT_SIZE', in_memory_sort_size):
+                gzipi.lib.sort_file(path, threads=1)
+            with open(path, 'rb') as fin:
+                return fin.read()
+
+    def test_keeps_duplicate_keys_in_file_order(self):
+        self.assertEqual(self.expected, self._sort_file(in_memory_sort_size=1 << 20))
+        if gzipi.lib.get_exe('gsort', 'sort'):
+            self.assertEqual(self.expected, self._sort_file(in_memory_sort_size=0))
+
+    def test_external_sort_agrees(self):
+        fout = io.BytesIO()
+        fout.close = lambda: None
+        writer = gzipi.lib.ExternalSortWriter(fout, run_size=2)
+        writer.write(self.data)
+        writer.close()
+        self.assertEqual(self.expected, fout.getvalue())
+
+
+class MmapBinarySearchTest(unittest.TestCase):
+    def test_searches_gzipped_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = P.join(tmpdir, 'index.gz')
+            with gzip.open(path, 'wb') as fout:
+                fout.write(b'a|1\nb|2\nc|3\n')
+            actual = gzipi.lib._mmap_binary_search(b'b', path)
+            self.assertEqual([b'2'], actual)
+            self.assertTrue(P.exists(path + '.idx'))
+
+    def test_read_only_index_directory(self):
+        mkstemp = tempfile.mkstemp
+
+        def fake_mkstemp(dir, **kwargs):
+            if dir == self.tmpdir:
+                raise PermissionError(13, 'Permission denied')
+            return mkstemp(dir=dir, **kwargs)
+
+        with tempfile.TemporaryDirectory() as self.tmpdir, \
+                tempfile.TemporaryDirectory() as fallback_dir:
+            path = P.join(self.tmpdir, 'index.gz')
+            with gzip.open(path, 'wb') as fout:
+                fout.write(b'a|1\nb|2\nc|3\n')
+            with mock.patch.object(gzipi.lib.tempfile, 'mkstemp', fake_mkstemp), \
+                    mock.patch.object(gzipi.lib.tempfile, 'tempdir', fallback_dir):
+                actual = gzipi.lib._mmap_binary_search(b'b', path)
+            self.assertEqual([b'2'], actual)
+            self.assertFalse(P.exists(path + '.idx'))
+            self.assertEqual(2, len(os.listdir(fallback_dir)))
+
+    def test_redecompresses_index_rewritten_with_same_mtime(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = P.join(tmpdir, 'index.gz')
+            with gzip.open(path, 'wb') as fout:
+                fout.write(b'a|1\nb|2\nc|3\n')
+            os.utime(path, ns=(0, 0))
+            self.assertEqual([b'2'], gzipi.lib._mmap_binary_search(b'b', path))
+            with gzip.open(path, 'wb') as fout:
+                fout.write(b'a|1\nb|22\nc|3\nd|4\n')
+            os.utime(path, ns=(0, 0))
+            self.assertEqual([b'22'], gzipi.lib._mmap_binary_search(b'b', path))
+
+    def test_missing_in_empty_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = P.join(tmpdir, 'index.gzi')
+            open(path, 'wb').close()
+            with self.assertRaises(KeyError):
+                gzipi.lib._mmap_binary_search(b'b', path)
+
+
+class ScanIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = b'a|0|1|0|1\nab|0|1|1|1\nb|2|1|0|1\nb|2|1|1|1\nc|3|1|0|1\n'
+        self.expected = {
+            0: [[b'ab', b'0', b'1', b'1', b'1']],
+            2: [[b'b', b'2', b'1', b'0', b'1'], [b'b', b'2', b'1', b'1', b'1']],
+        }
+
+    def test_unsorted(self):
+        actual = gzipi.lib._scan_index([b'b', b'ab', b'z'], io.BytesIO(self.index))
+        self.assertEqual(self.expected, actual)
+
+    def test_sorted(self):
+        actual = gzipi.lib._scan_index([b'b', b'ab', b'z'], io.BytesIO(self.index), True)
+        self.assertEqual(self.expected, actual)
+
+    def test_seeks_to_key(self):
+        fin = io.BytesIO(self.index)
+        gzipi.lib._seek_to_key(fin, b'b', len(self.index), b'|')
+        self.assertEqual(b'b|2|1|0|1\n', fin.readline())
+
+    def test_sorted_compressed_stream_is_read_sequentially(self):
+        fin = gzip.GzipFile(fileobj=io.BytesIO(gzip.compress(self.index)))
+        with mock.patch.object(gzipi.lib, '_seek_to_key') as seek_to_key:
+            actual = gzipi.lib._scan_index([b'b', b'ab', b'z'], fin, True)
+        self.assertEqual(self.expected, actual)
+        seek_to_key.assert_not_called()
+
+    def test_random_access(self):
+        self.assertTrue(gzipi.lib._is_random_access(io.BytesIO(self.index)))
+        with tempfile.TemporaryFile() as fin:
+            self.assertTrue(gzipi.lib._is_random_access(fin))
+        fin = gzip.GzipFile(fileobj=io.BytesIO(gzip.compress(self.index)))
+        self.assertFalse(gzipi.lib._is_random_access(fin))
+        self.assertFalse(gzipi.lib._is_random_access(io.BufferedReader(fin)))
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'rb') as pipe, open(write_fd, 'wb'):
+            self.assertFalse(gzipi.lib._is_random_access(pipe))
+
+
+class BisectIndexTest(unittest.TestCase):
+    def test_finds_first_line(self):
+        index = b'012440|0|0|0|0\n042235|1|1|1|1\n'
+        actual = gzipi.lib._bisect_index(b'012440', index)
+        self.assertEqual([b'0', b'0', b'0', b'0'], actual)
+
+    def test_finds_last_line_without_terminator(self):
+        index = b'a|1\nb|2\nc|3'
+        self.assertEqual([b'3'], gzipi.lib._bisect_index(b'c', index))
+
+    def test_missing(self):
+        index = b'a|1\nb|2\nc|3\n'
+        for key in (b'', b'0', b'bb', b'd'):
+            with self.assertRaises(KeyError):
+                gzipi.lib._bisect_index(key, index)
+
+    def test_key_with_delimiter(self):
+        with self.assertRaises(KeyError):
+            gzipi.lib._bisect_index(b'a|0', b'a|0|10|0|5\n')
+
+    def test_bisects_index_larger_than_a_page(self):
+        index = b''.join(b'%06d|%d\n' % (i, i) for i in range(0, 20000, 2))
+        for i in (0, 2, 1000, 9998, 19998):
+            self.assertEqual([b'%d' % i], gzipi.lib._bisect_index(b'%06d' % i, index))
+        for key in (b'000001', b'009999', b'099999'):
+            with self.assertRaises(KeyError):
+                gzipi.lib._bisect_index(key, index)
+
+
+class ExternalSortWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.lines = [b'd|1\n', b'b|2\n', b'e|3\n', b'a|4\n', b'c|5\n']
+        self.expected = b'a|4\nb|2\nc|5\nd|1\ne|3\n'
+
+    def _sort(self, run_size):
+        fout = io.BytesIO()
+        fout.close = lambda: None
+        writer = gzipi.lib.ExternalSortWriter(fout, run_size=run_size)
+        for line in self.lines:
+            writer.write(line)
+        writer.close()
+        return fout.getvalue()
+
+    def test_sorts_in_memory(self):
+        self.assertEqual(self._sort(run_size=100), self.expected)
+
+    def test_merges_spilled_runs(self):
+        self.assertEqual(self._sort(run_size=2), self.expected)
+
+    def test_handles_lines_split_across_writes(self):
+        self.lines = [b'd|1\nb|', b'2\ne|3\na|4\nc|5']
+        self.assertEqual(self._sort(run_size=2), self.expected)
+
+
+class IndexMetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = P.join(self.tmpdir.name, 'index.gzi')
+        with open(self.path, 'wb') as fout:
+            fout.write(b'b|1\nc|2\nd|3\n')
+        gzipi.lib.write_index_metadata(self.path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_key_in_range(self):
+        self.assertTrue(gzipi.lib._key_in_range(b'b', self.path))
+        self.assertTrue(gzipi.lib._key_in_range(b'cc', self.path))
+        self.assertTrue(gzipi.lib._key_in_range(b'd', self.path))
+
+    def test_key_out_of_range(self):
+        self.assertFalse(gzipi.lib._key_in_range(b'a', self.path))
+        self.assertFalse(gzipi.lib._key_in_range(b'e', self.path))
+
+    def test_ignores_stale_metadata(self):
+        with open(self.path, 'ab') as fout:
+            fout.write(b'e|4\n')
+        self.assertTrue(gzipi.lib._key_in_range(b'e', self.path))
+
+    def test_reads_keys_from_gzipped_index(self):
+        path = P.join(self.tmpdir.name, 'index.gz')
+        with gzip.open(path, 'wb') as fout:
+            fout.write(b'b|1\n' + b'c|2\n' * 100000 + b'd|3\n')
+        gzipi.lib.write_index_metadata(path)
+        self.assertFalse(gzipi.lib._key_in_range(b'a', path))
+        self.assertTrue(gzipi.lib._key_in_range(b'd', path))
+        self.assertFalse(gzipi.lib._key_in_range(b'e', path))
+
+    def test_has_index_metadata(self):
+        self.assertTrue(gzipi.lib.has_index_metadata(self.path))
+        with open(self.path, 'ab') as fout:
+            fout.write(b'a|4\n')
+        self.assertFalse(gzipi.lib.has_index_metadata(self.path))
+        self.assertFalse(gzipi.lib.has_index_metadata(self.path + '.missing'))
+
+    def test_ignores_metadata_of_rewritten_index(self):
+        with open(self.path, 'wb') as fout:
+            fout.write(b'e|1\nf|2\ng|3\n')
+        os.utime(self.path, ns=(0, 0))
+        self.assertTrue(gzipi.lib._key_in_range(b'f', self.path))
+
+    def test_non_utf8_keys(self):
+        with open(self.path, 'wb') as fout:
+            fout.write(b'\xe9|1\n\xff|2\n')
+        gzipi.lib.write_index_metadata(self.path)
+        self.assertTrue(gzipi.lib._key_in_range(b'\xf0', self.path))
+        self.assertFalse(gzipi.lib._key_in_range(b'z', self.path))